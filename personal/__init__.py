@@ -10,12 +10,106 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='dev',
         DATABASE=os.path.join(app.instance_path, 'personal.sqlite'),
+        # connections are pooled per process and opened with these pragmas
+        DATABASE_POOL_SIZE=8,
+        DATABASE_POOL_TIMEOUT=10,
+        DATABASE_CACHED_STATEMENTS=256,
+        DATABASE_BUSY_TIMEOUT=5000,
+        DATABASE_CACHE_SIZE=-16000,
+        DATABASE_MMAP_SIZE=128 * 1024 * 1024,
+        # statements slower than this are logged and counted in /metrics
+        DATABASE_SLOW_QUERY_MS=100,
+        POSTS_PER_PAGE=20,
+        # rendered fragments; 'lru' is per process, 'sqlite' is shared by
+        # all workers on the host and 'null' disables caching
+        CACHE_TYPE='lru',
+        CACHE_MAX_ENTRIES=2048,
+        CACHE_TTL=300,
+        CACHE_PATH=os.path.join(app.instance_path, 'cache.sqlite'),
+        # logged-in user rows; other workers see a changed row within the TTL
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=60,
+        # werkzeug hash method; stored hashes are upgraded at next login.
+        # PASSWORD_HASH_WORKERS=0 hashes inline on the request thread.
+        PASSWORD_HASH_METHOD='pbkdf2:sha256:600000',
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_QUEUE=16,
+        PASSWORD_HASH_TIMEOUT=10,
+        # content-addressed blob store for post images
+        UPLOAD_FOLDER=os.path.join(app.instance_path, 'uploads'),
+        UPLOAD_MAX_BYTES=16 * 1024 * 1024,
+        # internal nginx location to hand downloads to, e.g. '/_uploads';
+        # USE_X_SENDFILE=True does the same for Apache/lighttpd
+        UPLOAD_ACCEL_REDIRECT=None,
+        # responses smaller than this are sent uncompressed
+        GZIP_MIN_SIZE=1024,
+        GZIP_LEVEL=6,
+        # rows read per query by the streaming export API
+        EXPORT_CHUNK_SIZE=1000,
+        # per-request timing (Server-Timing header) and Prometheus /metrics.
+        # /metrics answers only loopback clients; to scrape it from another
+        # host set METRICS_TOKEN and send 'Authorization: Bearer <token>'.
+        # Behind a proxy on the same host every request looks like loopback,
+        # so set the token there too, or keep the proxy from forwarding it.
+        METRICS_ENABLED=True,
+        METRICS_TOKEN=None,
+        # apply likes and comments on a background thread, up to
+        # WRITE_BEHIND_BATCH per transaction every WRITE_BEHIND_INTERVAL
+        # seconds; users wait at most WRITE_BEHIND_WAIT to see their own
+        WRITE_BEHIND=False,
+        WRITE_BEHIND_QUEUE=10000,
+        WRITE_BEHIND_BATCH=500,
+        WRITE_BEHIND_INTERVAL=0.05,
+        WRITE_BEHIND_WAIT=2,
+        # comments shown per page of a post; older ones load on demand
+        COMMENTS_PER_PAGE=20,
+        # live comment and like updates over Server-Sent Events; 'local'
+        # reaches the streams of this process, 'sqlite' those of every
+        # worker on the host through a change log they poll
+        LIVE_BACKEND='local',
+        LIVE_PATH=os.path.join(app.instance_path, 'live.sqlite'),
+        LIVE_POLL_INTERVAL=0.25,
+        # events kept for streams that reconnect
+        LIVE_HISTORY=1000,
+        LIVE_KEEPALIVE=15,
+        # streams end after this long and the browser reconnects, so
+        # idle tabs do not hold a request thread for ever
+        LIVE_STREAM_SECONDS=300,
+        LIVE_RETRY_MS=3000,
+        # background upkeep: seconds between runs of each task, shared by
+        # all workers; empty disables the scheduler (`flask maintenance
+        # run` still works, e.g. from cron)
+        MAINTENANCE_SCHEDULE={
+            'orphans': 6 * 3600,
+            'uploads': 6 * 3600,
+            'vacuum': 3600,
+            'optimize': 3600,
+            'analyze': 24 * 3600,
+            'trending': 3600,
+        },
+        # rowids checked per orphan-cleanup transaction, and the pause
+        # after each one that lets other writers in
+        MAINTENANCE_BATCH=2000,
+        MAINTENANCE_PAUSE=0.05,
+        MAINTENANCE_VACUUM_PAGES=256,
+        # uploaded files younger than this may belong to a post being saved
+        MAINTENANCE_UPLOAD_GRACE=3600,
+        # posts listed by blog.trending, and the score below which a post
+        # drops out of the ranking (a like is worth 1 when new)
+        TRENDING_SIZE=20,
+        TRENDING_FLOOR=0.01,
+        # `flask backup` copies this many pages per step and sleeps between
+        # steps, so a backup of a live database leaves room for requests
+        BACKUP_FOLDER=os.path.join(app.instance_path, 'backups'),
+        BACKUP_PAGES=256,
+        BACKUP_SLEEP=0.01,
+        # compiled templates persist here across restarts; None disables
+        TEMPLATE_CACHE_DIR=os.path.join(app.instance_path, 'jinja'),
+        # compile templates and prime caches in create_app, for servers
+        # that load the app once before forking workers (gunicorn --preload)
+        WARM_UP=False,
     )
 
-    UPLOAD_FOLDER = '/var/www/Practice/Python/Flask/personal/personal/uploads'
-
-    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
     if test_config is None:
         # load the instance config, if it exists, when not testing
         app.config.from_pyfile('config.py', silent=True)
@@ -53,6 +147,10 @@ def create_app(test_config=None):
     from . import db
     db.init_app(app)
 
+    # first, so its timer starts before and its header is set after every other hook
+    from . import metrics
+    metrics.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -60,4 +158,52 @@ def create_app(test_config=None):
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
 
+    from . import cache
+    cache.init_app(app)
+
+    from . import uploads
+    uploads.init_app(app)
+
+    from . import assets
+    assets.init_app(app)
+
+    from . import search
+    app.register_blueprint(search.bp)
+
+    from . import api
+    app.register_blueprint(api.bp)
+
+    from . import writebehind
+    writebehind.init_app(app)
+
+    # after the blueprints, so g.user is loaded before ETags are checked
+    from . import middleware
+    middleware.init_app(app)
+
+    from . import bulk
+    bulk.init_app(app)
+
+    from . import warmup
+    warmup.init_app(app)
+
+    from . import maintenance
+    maintenance.init_app(app)
+
+    from . import trending
+    trending.init_app(app)
+
+    from . import backup
+    backup.init_app(app)
+
+    # benchmarks are only imported when a bench command runs
+    from .cli import LazyGroup
+    app.cli.add_command(LazyGroup('bench', 'personal.bench:bench',
+                                  help='Measure the app against synthetic databases.'))
+
+    from . import explain
+    app.cli.add_command(explain.explain_command)
+
+    if app.config['WARM_UP']:
+        warmup.warm_up(app)
+
     return app
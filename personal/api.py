@@ -0,0 +1,209 @@
+import csv
+import datetime
+import io
+import json
+
+from flask import Blueprint, current_app, g, request
+from werkzeug.exceptions import abort
+
+from personal.auth import login_required
+from personal.db import get_db, get_pool
+from personal.pagination import decode_cursor, encode_cursor
+
+bp = Blueprint('api', __name__, url_prefix='/api')
+
+# row id column, select list and joins of each export; every one is walked
+# in id order and joined to the post it belongs to for the filters
+EXPORTS = {
+    'posts': (
+        'p.id',
+        'p.id, p.uuid, a.uuid AS author, p.is_public, p.created, p.title, p.body,'
+        ' p.like_count, p.comment_count',
+        'post p JOIN user a ON a.id = p.author_id',
+        'p.created',
+    ),
+    'comments': (
+        'c.id',
+        'c.id, p.uuid AS post, u.uuid AS user, c.created, c.body',
+        'post_comment c JOIN post p ON p.id = c.post_id JOIN user u ON u.id = c.user_id',
+        'c.created',
+    ),
+    'likes': (
+        'l.rowid',
+        'l.rowid AS id, p.uuid AS post, u.uuid AS user, l.created',
+        'post_like l JOIN post p ON p.id = l.post_id JOIN user u ON u.id = l.user_id',
+        'l.created',
+    ),
+}
+
+
+def normalize_timestamp(value):
+    """An ISO 8601 date or time as the UTC 'YYYY-MM-DD HH:MM:SS' that
+    CURRENT_TIMESTAMP writes, so it compares as text with stored ones and
+    reads back through PARSE_DECLTYPES. Times without an offset are taken
+    to be UTC already. Raises ValueError when ``value`` does not parse."""
+    if not isinstance(value, str):
+        raise ValueError(f'Invalid timestamp {value!r}.')
+
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc)
+
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parse_timestamp(value):
+    try:
+        return normalize_timestamp(value)
+    except ValueError:
+        abort(400, f'Invalid timestamp {value!r}.')
+
+
+def export_filters(viewer_id, args):
+    """WHERE clauses and parameters for the author, visibility and created
+    range filters of an export request."""
+    clauses, params = [], []
+    visibility = args.get('visibility', 'all')
+
+    if visibility == 'public':
+        clauses.append('p.is_public = 1')
+    elif visibility == 'private':
+        clauses.append('p.is_public IS NOT 1 AND p.author_id = ?')
+        params.append(viewer_id)
+    elif visibility == 'all':
+        clauses.append('(p.is_public = 1 OR p.author_id = ?)')
+        params.append(viewer_id)
+    else:
+        abort(400, 'visibility must be public, private or all.')
+
+    if args.get('author'):
+        author = get_db().execute(
+            'SELECT id FROM user WHERE uuid = ?', (args['author'],)
+        ).fetchone()
+
+        if author is None:
+            abort(404, f"User {args['author']} doesn't exist.")
+
+        clauses.append('p.author_id = ?')
+        params.append(author['id'])
+
+    return clauses, params
+
+
+def export_rows(kind, viewer_id, args):
+    """Yield the rows of an export as dicts, reading ``EXPORT_CHUNK_SIZE``
+    rows per query. Every chunk is its own keyset query on the row id, on a
+    connection borrowed from the pool for that query only, so neither a
+    read transaction nor a connection is held while the client downloads,
+    and a stream the client abandons leaves nothing open."""
+    id_column, columns, tables, created = EXPORTS[kind]
+    clauses, params = export_filters(viewer_id, args)
+
+    if args.get('since'):
+        clauses.append(f'{created} >= ?')
+        params.append(parse_timestamp(args['since']))
+    if args.get('until'):
+        clauses.append(f'{created} < ?')
+        params.append(parse_timestamp(args['until']))
+
+    last_id = decode_cursor(args['after'], int)[0] if args.get('after') else 0
+    limit = args.get('limit', type=int)
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    sql = (
+        f'SELECT {columns} FROM {tables}'
+        f" WHERE {' AND '.join(clauses + [f'{id_column} > ?'])}"
+        f' ORDER BY {id_column} LIMIT ?'
+    )
+    # the request's connection goes back to the pool when the response
+    # starts, before the rows after the first chunk are read
+    pool = get_pool()
+
+    while limit is None or limit > 0:
+        size = chunk_size if limit is None else min(chunk_size, limit)
+        db = pool.acquire()
+        try:
+            rows = db.execute(sql, (*params, last_id, size)).fetchall()
+        finally:
+            pool.release(db)
+
+        for row in rows:
+            yield dict(row, cursor=encode_cursor(row['id']))
+
+        if len(rows) < size:
+            return
+
+        last_id = rows[-1]['id']
+        if limit is not None:
+            limit -= len(rows)
+
+
+def ndjson_lines(rows, chunk_size):
+    lines = []
+
+    for row in rows:
+        # created columns come back as datetimes; str() matches the CSV output
+        lines.append(json.dumps(row, separators=(',', ':'), default=str) + '\n')
+
+        # one write per chunk rather than per row
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines.clear()
+
+    if lines:
+        yield ''.join(lines)
+
+
+def csv_lines(rows, chunk_size):
+    buffer = io.StringIO()
+    writer = None
+
+    for n, row in enumerate(rows, 1):
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(row))
+            writer.writeheader()
+
+        writer.writerow(row)
+
+        if n % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@bp.route('/export/<any(posts, comments, likes):kind>')
+@login_required
+def export(kind):
+    """Stream every row of ``kind`` the viewer may see as NDJSON, or CSV with
+    ?format=csv. Filters: author (user uuid), since/until (ISO timestamps on
+    the row's created) and visibility (public, private or all). Each row has
+    a ``cursor``; pass the last one received as ?after= to resume."""
+    output = request.args.get('format', 'ndjson')
+
+    if output not in ('ndjson', 'csv'):
+        abort(400, 'format must be ndjson or csv.')
+
+    # run the filters' lookups and validation before the response starts
+    rows = export_rows(kind, g.user['id'], request.args)
+    first = next(rows, None)
+
+    def generate():
+        if first is not None:
+            yield first
+            yield from rows
+
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+
+    if output == 'csv':
+        body = csv_lines(generate(), chunk_size)
+        mimetype = 'text/csv'
+    else:
+        body = ndjson_lines(generate(), chunk_size)
+        mimetype = 'application/x-ndjson'
+
+    return current_app.response_class(
+        body, mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={kind}.{output}'}
+    )
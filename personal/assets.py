@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+
+# logical bundle name -> files under static/, in load order
+BUNDLES = {
+    'base.css': (
+        'assets/vendor/bootstrap/css/bootstrap.min.css',
+        'assets/vendor/bootstrap-icons/bootstrap-icons.css',
+        'assets/css/style.css',
+        'custom.css',
+    ),
+    'base.js': (
+        'assets/vendor/bootstrap/js/bootstrap.bundle.min.js',
+        'assets/js/main.js',
+    ),
+    # needs jQuery, which only layout/master.html loads
+    'custom.js': (
+        'custom.js',
+    ),
+    'charts.js': (
+        'assets/vendor/apexcharts/apexcharts.min.js',
+        'assets/vendor/chart.js/chart.min.js',
+        'assets/vendor/echarts/echarts.min.js',
+    ),
+    'tables.css': (
+        'assets/vendor/simple-datatables/style.css',
+    ),
+    'tables.js': (
+        'assets/vendor/simple-datatables/simple-datatables.js',
+    ),
+}
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+SPACE_RE = re.compile(r'\s+')
+PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*')
+
+
+def rebase_css(css, source):
+    """Point relative url()s of a stylesheet at the same files once its
+    text is moved into static/dist/."""
+    directory = posixpath.dirname(source)
+
+    def rebase(match):
+        quote, target = match.groups()
+        if target.startswith(('data:', 'http:', 'https:', '/', '#')):
+            return match.group(0)
+
+        path = posixpath.normpath(posixpath.join(directory, target))
+        return f'url({quote}{posixpath.relpath(path, DIST)}{quote})'
+
+    return URL_RE.sub(rebase, css)
+
+
+def minify_css(css):
+    css = COMMENT_RE.sub('', css)
+    css = SPACE_RE.sub(' ', css)
+    return PUNCTUATION_RE.sub(r'\1', css).strip()
+
+
+def build_bundle(static_folder, name, sources):
+    parts = []
+
+    for source in sources:
+        with open(os.path.join(static_folder, source), encoding='utf8') as f:
+            text = f.read()
+
+        if name.endswith('.css'):
+            parts.append(minify_css(rebase_css(text, source)))
+        else:
+            # vendor scripts ship minified; the rest are only concatenated
+            # because regex-minifying JavaScript is not safe
+            parts.append(text.rstrip() + '\n;')
+
+    content = '\n'.join(parts).encode('utf8')
+    stem, ext = os.path.splitext(name)
+    filename = f'{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+    path = os.path.join(static_folder, DIST, filename)
+
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    with gzip.open(path + '.gz', 'wb', compresslevel=9) as f:
+        f.write(content)
+
+    return posixpath.join(DIST, filename), len(content), os.path.getsize(path + '.gz')
+
+
+def build_assets(app, prune=False):
+    static_folder = app.static_folder
+    dist = os.path.join(static_folder, DIST)
+    os.makedirs(dist, exist_ok=True)
+
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        manifest[name], size, compressed = build_bundle(static_folder, name, sources)
+        click.echo(f'{name} -> {manifest[name]} ({size} bytes, {compressed} gzipped)')
+
+    # earlier bundles are kept by default so pages cached by clients or
+    # rendered by not yet restarted workers keep working
+    if prune:
+        current = {posixpath.basename(path) for path in manifest.values()}
+        for filename in os.listdir(dist):
+            if filename != MANIFEST and filename.removesuffix('.gz') not in current:
+                os.unlink(os.path.join(dist, filename))
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    app.extensions.pop('asset_manifest', None)
+
+
+def get_manifest():
+    manifest = current_app.extensions.get('asset_manifest')
+
+    if manifest is None:
+        try:
+            with open(os.path.join(current_app.static_folder, DIST, MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+
+        if not current_app.debug:
+            current_app.extensions['asset_manifest'] = manifest
+
+    return manifest
+
+
+def asset_tags(name):
+    """<link>/<script> tags for a bundle: its fingerprinted build when
+    `flask assets build` has run, otherwise the individual sources."""
+    built = get_manifest().get(name)
+    files = [built] if built else BUNDLES[name]
+    urls = [escape(url_for('static', filename=filename)) for filename in files]
+
+    if name.endswith('.css'):
+        tags = [f'<link href="{url}" rel="stylesheet">' for url in urls]
+    else:
+        tags = [f'<script src="{url}"></script>' for url in urls]
+
+    return Markup('\n'.join(tags))
+
+
+def send_static_file(filename):
+    if not filename.startswith(DIST + '/'):
+        return current_app.send_static_file(filename)
+
+    # bundle names change with their content, so they can be cached forever
+    # and the gzip build served to clients that accept it
+    mimetype = mimetypes.guess_type(filename)[0]
+    gzipped = os.path.join(current_app.static_folder, filename + '.gz')
+
+    if 'gzip' in request.accept_encodings and os.path.isfile(gzipped):
+        response = send_from_directory(current_app.static_folder, filename + '.gz',
+                                       mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(current_app.static_folder, filename,
+                                       mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
+
+
+assets = AppGroup('assets', help='Build fingerprinted static bundles.')
+
+
+@assets.command('build')
+@click.option('--prune', is_flag=True, help='Delete bundles of earlier builds.')
+def build_command(prune):
+    """Bundle, minify and gzip the static asset groups."""
+    build_assets(current_app, prune)
+
+
+def init_app(app):
+    app.view_functions['static'] = send_static_file
+    app.add_template_global(asset_tags)
+    app.cli.add_command(assets)
@@ -1,11 +1,13 @@
 import functools
+import os
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from personal.db import get_db
+from personal.cache import LRUCache
+from personal.db import close_db, get_db
+from personal.hashing import hash_password, needs_rehash, verify_password
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -17,7 +19,6 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = get_db()
         error = None
 
         if not username:
@@ -26,10 +27,13 @@ def register():
             error = 'Password is required.'
 
         if error is None:
+            # hashed before taking a connection, which would sit idle meanwhile
+            pwhash = hash_password(password)
+            db = get_db()
             try:
                 row = db.execute(
                     "INSERT INTO user (username, password) VALUES (?, ?)",
-                    (username, generate_password_hash(password)),
+                    (username, pwhash),
                 )
                 user_id = row.lastrowid
                 user_uuid = username + '.' + str(int(user_id) + int(USER_UID_KEY))
@@ -41,6 +45,7 @@ def register():
                 )
 
                 db.commit()
+                forget_user(user_id)
             except db.IntegrityError:
                 error = f"User {username} is already registered."
             else:
@@ -61,13 +66,25 @@ def login():
         user = db.execute(
             'SELECT * FROM user WHERE username = ?', (username,)
         ).fetchone()
+        # the connection goes back to the pool while the hash is checked,
+        # which can wait on the hashing workers for seconds
+        close_db()
 
-        if user is None:
-            error = 'Incorrect username.'
-        elif not check_password_hash(user['password'], password):
-            error = 'Incorrect password.'
+        # always verify a hash, so unknown usernames take as long as real ones
+        if not verify_password(user['password'] if user else None, password):
+            error = 'Incorrect username or password.'
 
         if error is None:
+            if needs_rehash(user['password']):
+                pwhash = hash_password(password)
+                db = get_db()
+                db.execute(
+                    'UPDATE user SET password = ? WHERE id = ?',
+                    (pwhash, user['id'])
+                )
+                db.commit()
+                forget_user(user['id'])
+
             session.clear()
             session['user_id'] = user['id']
             return redirect(url_for('index'))
@@ -79,15 +96,47 @@ def login():
 
 @bp.before_app_request
 def load_logged_in_user():
+    # checked before the session is touched, so static responses don't vary on Cookie
+    if request.endpoint == 'static':
+        g.user = None
+        return
+
     user_id = session.get('user_id')
 
     if user_id is None:
         g.user = None
-    else:
+        return
+
+    # most requests are served from the cache; its hits/misses are the
+    # DB-hit ratio of this hook (see /cache/stats)
+    cache = get_user_cache()
+    g.user = cache.get(user_id)
+
+    if g.user is None:
         g.user = get_db().execute(
             'SELECT * FROM user WHERE id = ?', (user_id,)
         ).fetchone()
 
+        if g.user is not None:
+            cache.set(user_id, g.user)
+
+
+def get_user_cache():
+    cache = current_app.extensions.get('user_cache')
+
+    if cache is None or cache[0] != os.getpid():
+        cache = current_app.extensions['user_cache'] = (
+            os.getpid(),
+            LRUCache(current_app.config['USER_CACHE_SIZE'], current_app.config['USER_CACHE_TTL'])
+        )
+
+    return cache[1]
+
+
+def forget_user(user_id):
+    """Drop a cached user row; call after changing it."""
+    get_user_cache().delete(user_id)
+
 
 @bp.route('/logout')
 def logout():
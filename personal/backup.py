@@ -0,0 +1,190 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import click
+from flask import current_app
+
+from personal.db import get_db, migrate, table_exists
+
+
+def integrity_errors(db):
+    """Problems PRAGMA integrity_check finds, or an empty list."""
+    rows = [row[0] for row in db.execute('PRAGMA integrity_check')]
+
+    return [] if rows == ['ok'] else rows
+
+
+def backup_database(source, path, pages, sleep, compress=False, check=False, busy_timeout=5000):
+    """Copy the database at ``source`` to ``path`` while it is in use.
+
+    The copy is made ``pages`` pages at a time with a ``sleep`` after each
+    step, from a read transaction held for the whole backup: in WAL mode
+    writers carry on, and the copy is the database as it was when the
+    backup started. (Without the snapshot, every write by another
+    connection would restart the backup.) Checkpoints cannot move past the
+    snapshot, so the WAL file grows until the backup is done.
+
+    The copy is written next to ``path`` and moved into place when it is
+    complete, so ``path`` is never a torn file. Returns the size of the
+    database and what was written."""
+    started = time.perf_counter()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, partial = tempfile.mkstemp(suffix='.part', dir=directory)
+    os.close(fd)
+
+    def pace(status, remaining, total):
+        if remaining:
+            time.sleep(sleep)
+
+    src = sqlite3.connect(source, isolation_level=None, timeout=busy_timeout / 1000)
+    try:
+        dst = sqlite3.connect(partial)
+        try:
+            src.execute('BEGIN')
+            src.execute('SELECT COUNT(*) FROM sqlite_schema').fetchone()
+            src.backup(dst, pages=pages, progress=pace)
+            src.execute('COMMIT')
+
+            # a single self-contained file rather than one that expects a -wal
+            dst.execute('PRAGMA journal_mode = DELETE')
+            page_count = dst.execute('PRAGMA page_count').fetchone()[0]
+            page_size = dst.execute('PRAGMA page_size').fetchone()[0]
+
+            if check:
+                errors = integrity_errors(dst)
+                if errors:
+                    raise click.ClickException('The backup failed its integrity check: ' + '; '.join(errors[:5]))
+        finally:
+            dst.close()
+
+        if compress:
+            with open(partial, 'rb') as f, open(partial + '.gz', 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as out:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+                os.fsync(raw.fileno())
+            os.replace(partial + '.gz', partial)
+        else:
+            with open(partial, 'rb') as f:
+                os.fsync(f.fileno())
+
+        os.replace(partial, path)
+    except BaseException:
+        for name in (partial, partial + '.gz'):
+            if os.path.exists(name):
+                os.remove(name)
+        raise
+    finally:
+        src.close()
+
+    return {
+        'path': path,
+        'pages': page_count,
+        'bytes': page_count * page_size,
+        'written': os.path.getsize(path),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def carry_versions(db, versions):
+    """Move every cache_version past ``versions``, those of the database
+    that was replaced, so fragments and ETags cached from it are never
+    mistaken for the restored data."""
+    db.executemany(
+        'INSERT INTO cache_version (key, version) VALUES (?, ?)'
+        ' ON CONFLICT (key) DO UPDATE SET version = MAX(version, excluded.version)',
+        ((key, version + 1) for key, version in versions)
+    )
+
+
+def restore_database(path, database, busy_timeout=5000):
+    """Replace ``database`` with the backup at ``path``, gzipped or not,
+    after checking the backup's integrity. Returns the pages restored."""
+    # on the database's filesystem, as a decompressed backup can be large
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(database))) as directory:
+        if is_gzip(path):
+            plain = os.path.join(directory, 'restore.sqlite')
+            with gzip.open(path, 'rb') as f, open(plain, 'wb') as out:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+            path = plain
+
+        src = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            try:
+                errors = integrity_errors(src)
+            except sqlite3.DatabaseError as e:
+                raise click.ClickException(f'Not a database backup: {e}') from None
+            if errors:
+                raise click.ClickException('The backup failed its integrity check: ' + '; '.join(errors[:5]))
+
+            dst = sqlite3.connect(database, timeout=busy_timeout / 1000)
+            try:
+                # the destination stays locked until the copy is complete,
+                # so it is made in one step
+                src.backup(dst)
+                return dst.execute('PRAGMA page_count').fetchone()[0]
+            finally:
+                dst.close()
+        finally:
+            src.close()
+
+
+def default_path(compress):
+    name = time.strftime('personal-%Y%m%d-%H%M%S.sqlite') + ('.gz' if compress else '')
+
+    return os.path.join(current_app.config['BACKUP_FOLDER'], name)
+
+
+@click.command('backup')
+@click.argument('path', required=False, type=click.Path(dir_okay=False))
+@click.option('--pages', type=int, help='Pages copied per step; -1 copies everything at once.')
+@click.option('--sleep', type=float, help='Seconds to wait between steps.')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the backup.')
+@click.option('--check', is_flag=True, help='Run an integrity check on the backup.')
+def backup_command(path, pages, sleep, compress, check):
+    """Copy the database to PATH while the app keeps running."""
+    config = current_app.config
+    result = backup_database(
+        config['DATABASE'], path or default_path(compress),
+        config['BACKUP_PAGES'] if pages is None else pages,
+        config['BACKUP_SLEEP'] if sleep is None else sleep,
+        compress, check, config['DATABASE_BUSY_TIMEOUT'],
+    )
+    click.echo(f"Backed up {result['pages']} pages ({result['bytes']} bytes) to {result['path']}"
+               f" in {result['seconds']}s; wrote {result['written']} bytes.")
+
+
+@click.command('restore')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.confirmation_option(prompt='Replace the database with this backup?')
+def restore_command(path):
+    """Replace the database with a backup made by `flask backup`, then
+    migrate it. Stop the app first: writers wait while it runs and
+    requests in flight may write to the old data."""
+    config = current_app.config
+    db = get_db()
+    versions = []
+    if table_exists(db, 'cache_version'):
+        versions = db.execute('SELECT key, version FROM cache_version').fetchall()
+    db.rollback()
+
+    pages = restore_database(path, config['DATABASE'], config['DATABASE_BUSY_TIMEOUT'])
+    names = migrate()
+    carry_versions(db, versions)
+    db.commit()
+
+    click.echo(f'Restored {pages} pages from {path}' + (f", applied {', '.join(names)}." if names else '.'))
+
+
+def init_app(app):
+    app.cli.add_command(backup_command)
+    app.cli.add_command(restore_command)
@@ -0,0 +1,616 @@
+import contextlib
+import http.client
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import click
+from flask.cli import AppGroup
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from personal.fixtures import WORDS, words
+
+bench = AppGroup('bench', help='Measure the app against synthetic databases.')
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def latencies(samples):
+    return {f'p{p}': round(percentile(samples, p) * 1000, 3) for p in (50, 95, 99)}
+
+
+def report(name, samples):
+    click.echo(f'{name}: n={len(samples)} ' + ' '.join(
+        f'{key}={value:.2f}ms' for key, value in latencies(samples).items()))
+
+
+def bench_app(directory, database='personal.sqlite', **config):
+    """App on a database in ``directory``, created unless it already exists.
+    Everything else it writes goes in ``directory`` too, and the
+    maintenance scheduler is off, so runs leave the instance folder alone."""
+    from personal import create_app
+    from personal.db import init_db
+
+    database = os.path.join(directory, database)
+    exists = os.path.exists(database)
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'bench',
+        'DATABASE': database,
+        'CACHE_PATH': os.path.join(directory, 'cache.sqlite'),
+        'LIVE_PATH': os.path.join(directory, 'live.sqlite'),
+        'UPLOAD_FOLDER': os.path.join(directory, 'uploads'),
+        'BACKUP_FOLDER': os.path.join(directory, 'backups'),
+        'TEMPLATE_CACHE_DIR': os.path.join(directory, 'jinja'),
+        'MAINTENANCE_SCHEDULE': {},
+        **config,
+    })
+
+    if not exists:
+        with app.app_context():
+            init_db()
+
+    return app
+
+
+@bench.command('search')
+@click.option('--posts', multiple=True, type=int, default=(10000, 100000),
+              help='Corpus sizes to measure; repeat for several.')
+@click.option('--queries', default=200, help='Queries timed per corpus size.')
+@click.option('--seed', default=1)
+def bench_search_command(posts, queries, seed):
+    """Time ranked full-text search on synthetic corpora."""
+    from personal.db import get_db
+    from personal.search import search_posts
+
+    for size in posts:
+        rng = random.Random(seed)
+
+        with tempfile.TemporaryDirectory() as directory:
+            app = bench_app(directory)
+
+            with app.app_context():
+                db = get_db()
+                db.execute("INSERT INTO user (uuid, username, password) VALUES ('bench.100', 'bench', '')")
+
+                for start in range(0, size, 10000):
+                    db.executemany(
+                        'INSERT INTO post (uuid, title, body, author_id, is_public) VALUES (?, ?, ?, 1, 1)',
+                        ((f'bench-{n}', words(rng, 6), words(rng, 120))
+                         for n in range(start, min(size, start + 10000)))
+                    )
+                db.commit()
+
+                samples = []
+                for _ in range(queries):
+                    # queries pick terms uniformly, so most are selective
+                    query = ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+                    started = time.perf_counter()
+                    search_posts(query, 1)
+                    samples.append(time.perf_counter() - started)
+
+            report(f'search posts={size}', samples)
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+@bench.command('login')
+@click.option('--logins', default=200, help='Logins per run.')
+@click.option('--concurrency', default=16, help='Threads logging in at once.')
+@click.option('--workers', multiple=True, type=int, default=(0, 2),
+              help='PASSWORD_HASH_WORKERS per run; 0 hashes inline. Repeat for several.')
+def bench_login_command(logins, concurrency, workers):
+    """Compare login throughput and concurrent page latency with and
+    without the password hashing pool."""
+    from personal.hashing import hash_password
+    from personal.db import get_db
+
+    for count in workers:
+        with tempfile.TemporaryDirectory() as directory:
+            app = bench_app(directory, PASSWORD_HASH_WORKERS=count, PASSWORD_HASH_QUEUE=concurrency)
+
+            with app.app_context():
+                db = get_db()
+                db.execute(
+                    "INSERT INTO user (uuid, username, password) VALUES ('bench.100', 'bench', ?)",
+                    (hash_password('bench'),)
+                )
+                db.commit()
+
+            results = {'ok': 0, 'refused': 0}
+            page_samples = []
+            done = threading.Event()
+            lock = threading.Lock()
+
+            def login(n):
+                client = app.test_client()
+                for _ in range(logins // concurrency):
+                    response = client.post('/auth/login', data={'username': 'bench', 'password': 'bench'})
+                    with lock:
+                        results['ok' if response.status_code == 302 else 'refused'] += 1
+
+            def browse():
+                client = app.test_client()
+                client.post('/auth/login', data={'username': 'bench', 'password': 'bench'})
+                while not done.is_set():
+                    started = time.perf_counter()
+                    client.get('/blog')
+                    page_samples.append(time.perf_counter() - started)
+
+            reader = threading.Thread(target=browse)
+            reader.start()
+            started = time.perf_counter()
+            run_threads(concurrency, login)
+            elapsed = time.perf_counter() - started
+            done.set()
+            reader.join()
+
+            click.echo(f"login workers={count}: {results['ok'] / elapsed:.1f} logins/s,"
+                       f" {results['refused']} refused")
+            report(f'  concurrent page views workers={count}', page_samples)
+
+
+@bench.command('export')
+@click.option('--rows', multiple=True, type=int, default=(100000, 1000000),
+              help='Posts to export; repeat for several.')
+@click.option('--format', 'output', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+def bench_export_command(rows, output):
+    """Check that streaming an export uses flat memory at any table size."""
+    from personal.db import get_db
+
+    for size in rows:
+        rng = random.Random(1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            app = bench_app(directory)
+
+            with app.app_context():
+                db = get_db()
+                db.execute("INSERT INTO user (uuid, username, password) VALUES ('bench.100', 'bench', '')")
+
+                for start in range(0, size, 10000):
+                    db.executemany(
+                        'INSERT INTO post (uuid, title, body, author_id, is_public) VALUES (?, ?, ?, 1, 1)',
+                        ((f'bench-{n}', words(rng, 6), words(rng, 40))
+                         for n in range(start, min(size, start + 10000)))
+                    )
+                db.commit()
+
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['user_id'] = 1
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            response = client.get(f'/api/export/posts?format={output}', buffered=False)
+            received = sum(len(chunk) for chunk in response.response)
+            response.close()
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            click.echo(f'export rows={size}: {received / 1024 / 1024:.1f}MB in {elapsed:.1f}s,'
+                       f' peak traced memory {peak / 1024:.0f}KB')
+
+
+# rows seeded for each --scale of `flask bench run`
+SCALES = {
+    'small': {'users': 100, 'posts': 2000, 'likes': 10000, 'comments': 4000},
+    'medium': {'users': 2000, 'posts': 50000, 'likes': 250000, 'comments': 100000},
+    'large': {'users': 20000, 'posts': 500000, 'likes': 2500000, 'comments': 1000000},
+}
+
+# relative weights of the endpoints within the read and the write share
+READS = {'blog.index': 4, 'blog.blog_self': 2, 'blog.details': 4}
+WRITES = {'blog.post_like': 4, 'blog.post_comment': 3, 'blog.create': 1, 'auth.login': 1}
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_request(self, *args):
+        pass
+
+
+class TestClient:
+    """Drives the app in-process through Flask's test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class HTTPClient:
+    """Drives the app over HTTP, keeping the session cookie."""
+
+    def __init__(self, address):
+        self.address = address
+        self.cookie = None
+
+    def request(self, method, path, data=None):
+        connection = http.client.HTTPConnection(*self.address, timeout=60)
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        body = None
+
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+        finally:
+            connection.close()
+
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+
+        return response.status
+
+
+def endpoint_request(endpoint, rng, fixtures, user):
+    """(method, path, form data) of one request to ``endpoint``."""
+    post_id = rng.choice(fixtures['posts'])
+
+    if endpoint == 'blog.index':
+        return 'GET', '/blog', None
+    if endpoint == 'blog.blog_self':
+        return 'GET', f"/blog/self/{rng.choice(fixtures['authors'])}", None
+    if endpoint == 'blog.details':
+        return 'GET', f'/{post_id}/details', None
+    if endpoint == 'blog.post_like':
+        return 'GET', f'/{post_id}/post_like', None
+    if endpoint == 'blog.post_comment':
+        return 'POST', f'/{post_id}/post_comment', {'body': words(rng, 20)}
+    if endpoint == 'blog.create':
+        return 'POST', '/blog/create', {'title': words(rng, 6), 'body': words(rng, 60)}
+
+    return 'POST', '/auth/login', {'username': user, 'password': 'password'}
+
+
+def load_fixtures(app):
+    from personal.db import get_db
+
+    with app.app_context():
+        db = get_db()
+        return {
+            'posts': [row[0] for row in db.execute('SELECT id FROM post WHERE is_public = 1')],
+            'authors': [row[0] for row in db.execute(
+                'SELECT uuid FROM user WHERE id IN (SELECT author_id FROM post)')],
+            'users': [row[0] for row in db.execute("SELECT username FROM user WHERE username LIKE 'seed%'")],
+        }
+
+
+def run_load(app, clients, fixtures, requests, write_ratio, seed):
+    """Send ``requests`` requests spread over one thread per client and
+    return (elapsed seconds, {endpoint: (latencies, errors)})."""
+    results = {endpoint: ([], [0]) for endpoint in {**READS, **WRITES}}
+    per_thread = requests // len(clients)
+
+    def work(n):
+        rng = random.Random(seed + n)
+        client = clients[n]
+        user = rng.choice(fixtures['users'])
+        client.request('POST', '/auth/login', {'username': user, 'password': 'password'})
+
+        for _ in range(per_thread):
+            mix = WRITES if rng.random() < write_ratio else READS
+            endpoint = rng.choices(list(mix), list(mix.values()))[0]
+            method, path, data = endpoint_request(endpoint, rng, fixtures, user)
+
+            started = time.perf_counter()
+            status = client.request(method, path, data)
+            samples, errors = results[endpoint]
+            samples.append(time.perf_counter() - started)
+            if status >= 400:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    run_threads(len(clients), work)
+
+    return time.perf_counter() - started, results
+
+
+def seeded_database(directory, scale, seed):
+    """Path of the database seeded for ``scale`` in ``directory``, seeding
+    it unless an earlier run left it there."""
+    from personal.bulk import seed_database
+    from personal.db import get_db
+
+    database = f'personal-{scale}.sqlite'
+    seeded = os.path.exists(os.path.join(directory, database))
+    app = bench_app(directory, database)
+
+    with app.app_context():
+        if not seeded:
+            seed_database(**SCALES[scale], seed=seed)
+        get_db().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    return os.path.join(directory, database)
+
+
+def compare(run, baseline, tolerance):
+    """Regressions of ``run`` against the matching run of ``baseline``."""
+    regressions = []
+    key = (run['scale'], run['server'], run['concurrency'], run['write_ratio'])
+    previous = next((old for old in baseline['runs'] if
+                     (old['scale'], old['server'], old['concurrency'], old['write_ratio']) == key), None)
+
+    if previous is None:
+        return regressions
+
+    if run['throughput'] < previous['throughput'] * (1 - tolerance):
+        regressions.append(f"{run['scale']}: {previous['throughput']} -> {run['throughput']} req/s")
+
+    for endpoint, result in run['endpoints'].items():
+        old = previous['endpoints'].get(endpoint)
+
+        if old and result['requests'] and result['p95'] > old['p95'] * (1 + tolerance):
+            regressions.append(f"{run['scale']} {endpoint}: p95 {old['p95']:.2f}ms -> {result['p95']:.2f}ms")
+
+    return regressions
+
+
+@bench.command('run')
+@click.option('--scale', 'scales', multiple=True, type=click.Choice(list(SCALES)), default=('small',),
+              help='Seeded database sizes to measure; repeat for several.')
+@click.option('--directory', type=click.Path(file_okay=False),
+              help='Keep the seeded databases here and reuse them in later runs.')
+@click.option('--server', type=click.Choice(['client', 'wsgi']), default='client',
+              help='Flask test client in-process, or a threaded WSGI server over HTTP.')
+@click.option('--requests', default=2000, help='Requests per scale.')
+@click.option('--concurrency', default=8, help='Clients sending requests at once.')
+@click.option('--write-ratio', default=0.1, help='Share of requests that write.')
+@click.option('--output', type=click.File('w'), help='Write the results as JSON here.')
+@click.option('--baseline', type=click.File('r'), help='JSON of an earlier run to compare with.')
+@click.option('--tolerance', default=0.2, help='Allowed slowdown against the baseline.')
+@click.option('--seed', default=1)
+def bench_run_command(scales, directory, server, requests, concurrency, write_ratio,
+                      output, baseline, tolerance, seed):
+    """Load-test the blog endpoints on seeded databases."""
+    baseline = json.load(baseline) if baseline else None
+    runs, regressions = [], []
+
+    with contextlib.ExitStack() as stack:
+        directory = directory or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(directory, exist_ok=True)
+
+        for scale in scales:
+            # every run writes to a fresh copy, so runs start from the same rows
+            run_directory = stack.enter_context(tempfile.TemporaryDirectory())
+            shutil.copyfile(seeded_database(directory, scale, seed), os.path.join(run_directory, 'personal.sqlite'))
+            app = bench_app(run_directory, DATABASE_POOL_SIZE=concurrency + 2)
+
+            if server == 'wsgi':
+                httpd = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+                threading.Thread(target=httpd.serve_forever, daemon=True).start()
+                clients = [HTTPClient(httpd.server_address) for _ in range(concurrency)]
+            else:
+                clients = [TestClient(app) for _ in range(concurrency)]
+
+            try:
+                elapsed, results = run_load(app, clients, load_fixtures(app), requests, write_ratio, seed)
+            finally:
+                if server == 'wsgi':
+                    httpd.shutdown()
+
+            run = {
+                'scale': scale,
+                'rows': SCALES[scale],
+                'server': server,
+                'concurrency': concurrency,
+                'write_ratio': write_ratio,
+                'elapsed': round(elapsed, 3),
+                'throughput': round(sum(len(samples) for samples, _ in results.values()) / elapsed, 1),
+                'endpoints': {},
+            }
+            click.echo(f"{scale} ({server}): {run['throughput']} req/s")
+
+            for endpoint, (samples, errors) in sorted(results.items()):
+                run['endpoints'][endpoint] = {
+                    'requests': len(samples),
+                    'errors': errors[0],
+                    'throughput': round(len(samples) / elapsed, 1),
+                    **(latencies(samples) if samples else {}),
+                }
+                if samples:
+                    report(f'  {endpoint} errors={errors[0]}', samples)
+
+            runs.append(run)
+            if baseline:
+                regressions += compare(run, baseline, tolerance)
+
+    if output:
+        json.dump({'runs': runs}, output, indent=2)
+
+    if regressions:
+        click.echo('Regressions against the baseline:')
+        for regression in regressions:
+            click.echo(f'  {regression}')
+        raise SystemExit(1)
+
+
+@bench.command('writes')
+@click.option('--requests', default=2000, help='Like toggles and comments per run.')
+@click.option('--concurrency', default=8, help='Clients writing at once.')
+@click.option('--posts', default=50, help='Posts the writes go to; fewer means more coalescing.')
+def bench_writes_command(requests, concurrency, posts):
+    """Compare like and comment throughput with and without write-behind."""
+    from personal.bulk import seed_database
+    from personal.writebehind import get_writer
+
+    for write_behind in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            app = bench_app(directory, WRITE_BEHIND=write_behind, DATABASE_POOL_SIZE=concurrency + 2,
+                            DATABASE_SLOW_QUERY_MS=1000)
+
+            with app.app_context():
+                seed_database(users=concurrency, posts=posts)
+
+            samples = []
+
+            def write(n):
+                rng = random.Random(n)
+                client = app.test_client()
+                with client.session_transaction() as session:
+                    session['user_id'] = n + 1
+
+                for _ in range(requests // concurrency):
+                    post_id = rng.randint(1, posts)
+                    started = time.perf_counter()
+                    if rng.random() < 0.5:
+                        client.get(f'/{post_id}/post_like')
+                    else:
+                        client.post(f'/{post_id}/post_comment', data={'body': words(rng, 10)})
+                    samples.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            run_threads(concurrency, write)
+            commits = requests
+
+            with app.app_context():
+                writer = get_writer()
+                if writer is not None:
+                    # count the time until every intent is durable
+                    writer.close()
+                    commits = writer.batches
+
+            elapsed = time.perf_counter() - started
+            click.echo(f'write-behind={write_behind}: {len(samples) / elapsed:.1f} writes/s'
+                       f' in {commits} commits')
+            report('  request latency', samples)
+
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+from personal import create_app
+app = create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+client = app.test_client()
+with client.session_transaction() as session:
+    session['user_id'] = 1
+client.get('/blog')
+first = time.perf_counter()
+client.get('/1/details')
+print(json.dumps({'create': created - started, 'first': first - created, 'second': time.perf_counter() - first}))
+'''
+
+
+@bench.command('startup')
+@click.option('--runs', default=5, help='Fresh processes started per mode.')
+def bench_startup_command(runs):
+    """Time create_app and the first requests of a fresh process, without
+    and with the template bytecode cache and warm-up."""
+    import statistics
+    import subprocess
+    import sys
+
+    from personal.bulk import seed_database
+    from personal.warmup import compile_templates
+
+    with tempfile.TemporaryDirectory() as directory:
+        template_cache = os.path.join(directory, 'jinja')
+        app = bench_app(directory, TEMPLATE_CACHE_DIR=template_cache)
+        with app.app_context():
+            seed_database(users=10, posts=100, likes=200, comments=200)
+
+        config = {
+            'SECRET_KEY': 'bench',
+            'DATABASE': app.config['DATABASE'],
+            'CACHE_PATH': app.config['CACHE_PATH'],
+        }
+        modes = {
+            'cold': {**config, 'TEMPLATE_CACHE_DIR': None},
+            'bytecode cache': {**config, 'TEMPLATE_CACHE_DIR': template_cache},
+            'warm-up': {**config, 'TEMPLATE_CACHE_DIR': template_cache, 'WARM_UP': True},
+        }
+        compile_templates(app)
+
+        for mode, mode_config in modes.items():
+            results = [json.loads(subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT, json.dumps(mode_config)],
+                check=True, capture_output=True, text=True,
+            ).stdout) for _ in range(runs)]
+
+            click.echo(f'{mode}: ' + ' '.join(
+                f'{key}={statistics.median(result[key] for result in results) * 1000:.1f}ms'
+                for key in ('create', 'first', 'second')
+            ))
+
+
+@bench.command('backup')
+@click.option('--scale', type=click.Choice(list(SCALES)), default='medium', help='Seeded database size.')
+@click.option('--directory', type=click.Path(file_okay=False),
+              help='Keep the seeded database here and reuse it in later runs.')
+@click.option('--requests', default=2000, help='Requests per run.')
+@click.option('--concurrency', default=8, help='Clients sending requests at once.')
+@click.option('--write-ratio', default=0.1, help='Share of requests that write.')
+@click.option('--pages', multiple=True, type=int, default=(-1, 256),
+              help='Pages per backup step to compare; -1 copies everything at once. Repeat for several.')
+@click.option('--sleep', default=0.01, help='Seconds between backup steps.')
+@click.option('--seed', default=1)
+def bench_backup_command(scale, directory, requests, concurrency, write_ratio, pages, sleep, seed):
+    """Compare request latency with no backup running and with backups
+    made back to back during the load."""
+    from personal.backup import backup_database
+
+    with contextlib.ExitStack() as stack:
+        directory = directory or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(directory, exist_ok=True)
+        database = seeded_database(directory, scale, seed)
+
+        for step in (None, *pages):
+            run_directory = stack.enter_context(tempfile.TemporaryDirectory())
+            shutil.copyfile(database, os.path.join(run_directory, 'personal.sqlite'))
+            app = bench_app(run_directory, DATABASE_POOL_SIZE=concurrency + 2)
+            clients = [TestClient(app) for _ in range(concurrency)]
+            durations = []
+            done = threading.Event()
+
+            def back_up():
+                while not done.is_set():
+                    result = backup_database(app.config['DATABASE'], os.path.join(run_directory, 'backup.sqlite'),
+                                             step, sleep)
+                    durations.append(result['seconds'])
+
+            backups = threading.Thread(target=back_up)
+            if step is not None:
+                backups.start()
+
+            try:
+                elapsed, results = run_load(app, clients, load_fixtures(app), requests, write_ratio, seed)
+            finally:
+                done.set()
+                if step is not None:
+                    backups.join()
+
+            # logins wait on password hashing, which would hide everything else in the p99
+            timed = [result for endpoint, result in results.items() if endpoint != 'auth.login']
+            samples = [sample for endpoint_samples, _ in timed for sample in endpoint_samples]
+            errors = sum(endpoint_errors[0] for _, endpoint_errors in timed)
+
+            if step is None:
+                click.echo(f'no backup: {len(samples) / elapsed:.1f} req/s')
+            else:
+                click.echo(f'backup pages={step} sleep={sleep}: {len(samples) / elapsed:.1f} req/s,'
+                           f' {len(durations)} backups of {sum(durations) / len(durations):.2f}s on average')
+            report(f'  requests other than logins errors={errors}', samples)
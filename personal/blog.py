@@ -1,48 +1,131 @@
-import os
+import json
+import sqlite3
 import uuid
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for, jsonify
+    Blueprint, current_app, flash, g, redirect, render_template, request, url_for, jsonify
 )
 from werkzeug.exceptions import abort
 from werkzeug.utils import secure_filename
 
 from personal.auth import login_required
+from personal.cache import bump_versions, cached_fragment, get_versions
 from personal.db import get_db
+from personal.live import comment_data, event_stream, publish_post_event
+from personal.middleware import etag_versions
+from personal.pagination import decode_cursor, encode_cursor, keyset_page
+from personal.uploads import allowed_file, reclaim, store_upload
+from personal.writebehind import get_writer
 
 bp = Blueprint('blog', __name__)
 
-UPLOAD_FOLDER = '/var/www/Practice/Python/Flask/personal/personal/static/uploads'
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
-
-
 @bp.route('/blog')
+@etag_versions(lambda: ('feed',))
 @login_required
 def index():
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, username'
+    after = request.args.get('after')
+    before = request.args.get('before')
+    version, = get_versions('feed')
+
+    def render():
+        posts, next_cursor, prev_cursor = get_public_posts(after, before)
+        stats = load_posts((post['id'] for post in posts), g.user['id'])
+
+        return render_template('blog/_feed.html', posts=posts, stats=stats,
+                               next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+    # the edit pencils and liked flags differ per viewer
+    feed = cached_fragment(('feed', version, after, before, g.user['id']), render)
+
+    return render_template('blog/index.html', feed=feed)
+
+
+def get_public_posts(after=None, before=None):
+    # keyset pagination on (created, id), served by post_public_created_idx
+    limit = current_app.config['POSTS_PER_PAGE']
+    query = (
+        'SELECT p.id, title, created, author_id, username'
         ' FROM post p JOIN user u ON p.author_id = u.id'
         ' WHERE p.is_public = 1'
-        ' ORDER BY created DESC'
+    )
+    params = ()
+
+    if before is not None:
+        created, post_id = decode_cursor(before, str, int)
+        query += ' AND (p.created, p.id) > (?, ?) ORDER BY p.created ASC, p.id ASC'
+        params = (created, post_id)
+    elif after is not None:
+        created, post_id = decode_cursor(after, str, int)
+        query += ' AND (p.created, p.id) < (?, ?) ORDER BY p.created DESC, p.id DESC'
+        params = (created, post_id)
+    else:
+        query += ' ORDER BY p.created DESC, p.id DESC'
+
+    posts = get_db().execute(query + ' LIMIT ?', params + (limit + 1,)).fetchall()
+
+    return keyset_page(posts, limit, lambda post: (post['created'], post['id']),
+                       after=after, before=before)
+
+
+@bp.route('/blog/trending')
+@etag_versions(lambda: ('feed',))
+@login_required
+def trending():
+    version, = get_versions('feed')
+
+    def render():
+        posts = get_trending_posts()
+        stats = load_posts((post['id'] for post in posts), g.user['id'])
+
+        return render_template('blog/_feed.html', posts=posts, stats=stats, next_cursor=None, prev_cursor=None)
+
+    feed = cached_fragment(('trending', version, g.user['id']), render)
+
+    return render_template('blog/trending.html', feed=feed)
+
+
+def get_trending_posts():
+    # the top of post_trending_rank_idx, however many likes there are
+    return get_db().execute(
+        'SELECT p.id, title, created, author_id, username'
+        ' FROM post_trending t JOIN post p ON p.id = t.post_id JOIN user u ON p.author_id = u.id'
+        ' WHERE t.is_public = 1'
+        ' ORDER BY t.score DESC LIMIT ?',
+        (current_app.config['TRENDING_SIZE'],)
     ).fetchall()
-    return render_template('blog/index.html', posts=posts)
+
+
+def author_versions(user_uuid):
+    user = get_user_by_uuid(user_uuid)
+
+    return user and (f"author:{user['id']}",)
 
 
 @bp.route('/blog/self/<string:user_uuid>')
+@etag_versions(author_versions)
 @login_required
 def blog_self(user_uuid):
     user = get_user_by_uuid(user_uuid)
+
+    if user is None:
+        abort(404, f"User {user_uuid} doesn't exist.")
+
     is_own = user['id'] == g.user['id']
+    version, = get_versions(f"author:{user['id']}")
 
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' WHERE u.uuid = ?',
-        (str(user_uuid),)
-    ).fetchall()
-    return render_template('blog/self.html', posts=posts, user=user, is_own=is_own)
+    def render():
+        posts = get_db().execute(
+            'SELECT p.id, title, body, created, author_id, username'
+            ' FROM post p JOIN user u ON p.author_id = u.id'
+            ' WHERE u.uuid = ?',
+            (str(user_uuid),)
+        ).fetchall()
+
+        return render_template('blog/_self.html', posts=posts, is_own=is_own)
+
+    post_list = cached_fragment(('author', user['id'], version, is_own), render)
+
+    return render_template('blog/self.html', post_list=post_list, user=user, is_own=is_own)
 
 
 @bp.route('/blog/create', methods=('GET', 'POST'))
@@ -78,14 +161,14 @@ def create():
                         db.rollback()
                         return redirect(request.url)
                     filename = secure_filename(file.filename)
-                    file.save(os.path.join(UPLOAD_FOLDER, filename))
+                    blob_hash = store_upload(db, file)
 
-                    db = get_db()
                     db.execute(
-                        'INSERT INTO post_image (post_id, name)'
-                        ' VALUES (?, ?)',
-                        (post_id, filename)
+                        'INSERT INTO post_image (post_id, name, blob_hash)'
+                        ' VALUES (?, ?, ?)',
+                        (post_id, filename, blob_hash)
                     )
+            bump_versions(db, f"author:{g.user['id']}")
             db.commit()
 
             return redirect(url_for('blog.index'))
@@ -95,7 +178,8 @@ def create():
 
 def get_post(id, check_author=True):
     post = get_db().execute(
-        'SELECT p.id, title, body, is_public, created, author_id, username'
+        'SELECT p.id, title, body, is_public, created, author_id, username,'
+        ' like_count, comment_count'
         ' FROM post p JOIN user u ON p.author_id = u.id'
         ' WHERE p.id = ?',
         (id,)
@@ -147,33 +231,40 @@ def get_post_image(post_id, image_id):
     return post_image
 
 
-def get_post_like(post_id, user_id):
-    like = get_db().execute(
-        'SELECT * FROM post_like WHERE post_id = ? AND user_id = ?', (post_id, user_id)
+def get_post_like_total(post_id):
+    post = get_db().execute(
+        'SELECT like_count FROM post WHERE id = ?', (post_id,)
     ).fetchone()
 
-    if like is None:
-        return None
+    return post['like_count'] if post else 0
 
-    return like
 
+def get_comment_page(post_id, before=None):
+    """The newest COMMENTS_PER_PAGE comments of a post, or those older
+    than comment id ``before``, oldest first, and the cursor of the page
+    of comments older than them (None when there are none)."""
+    limit = current_app.config['COMMENTS_PER_PAGE']
+    query = (
+        'SELECT p.id, post_id, body, created, user_id, username'
+        ' FROM post_comment p JOIN user u ON p.user_id = u.id'
+        ' WHERE post_id = ?'
+    )
+    args = [post_id]
 
-def get_post_like_total(post_id):
-    like_total = get_db().execute(
-        'SELECT * FROM post_like WHERE post_id = ?', (post_id,)
-    ).fetchall()
+    if before is not None:
+        query += ' AND p.id < ?'
+        args.append(before)
 
-    return len(like_total)
+    rows = get_db().execute(query + ' ORDER BY p.id DESC LIMIT ?', (*args, limit + 1)).fetchall()
+    older = encode_cursor(rows[limit - 1]['id']) if len(rows) > limit else None
 
+    return rows[:limit][::-1], older
 
-def get_post_comments(post_id):
-    post_comments = get_db().execute(
-        'SELECT p.id, post_id, body, created, user_id, username'
-        ' FROM post_comment p JOIN user u ON p.user_id = u.id'
-        ' WHERE post_id = ?', (post_id,)
-    ).fetchall()
 
-    return post_comments
+def wants_json():
+    """Whether the client asked for JSON rather than a page, as the
+    scripts of the details page do."""
+    return request.accept_mimetypes.best_match(('text/html', 'application/json')) == 'application/json'
 
 
 def get_post_images(post_id):
@@ -184,6 +275,75 @@ def get_post_images(post_id):
     return post_images
 
 
+def load_posts(ids, viewer_id, with_comments=False):
+    """Batch-load everything a post page shows for many posts at once.
+
+    One query returns each post with its author, counters, images and
+    whether ``viewer_id`` liked it; ``with_comments`` adds a single query
+    for all their comments. Returns a dict keyed by post id."""
+    ids = list(ids)
+    if not ids:
+        return {}
+
+    db = get_db()
+    marks = ', '.join('?' * len(ids))
+    rows = db.execute(
+        'SELECT p.id, p.uuid, title, body, is_public, created, author_id, username,'
+        ' like_count, comment_count,'
+        ' EXISTS (SELECT 1 FROM post_like l WHERE l.post_id = p.id AND l.user_id = ?) AS liked,'
+        " (SELECT json_group_array(json_object('id', i.id, 'post_id', i.post_id, 'name', i.name,"
+        " 'blob_hash', i.blob_hash))"
+        '  FROM (SELECT * FROM post_image WHERE post_id = p.id ORDER BY id) i) AS images'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        f' WHERE p.id IN ({marks})',
+        (viewer_id, *ids)
+    ).fetchall()
+
+    posts = {}
+    for row in rows:
+        post = dict(row)
+        post['images'] = json.loads(row['images'])
+        post['comments'] = []
+        posts[row['id']] = post
+
+    if with_comments:
+        comments = db.execute(
+            'SELECT p.id, post_id, body, created, user_id, username'
+            ' FROM post_comment p JOIN user u ON p.user_id = u.id'
+            f' WHERE post_id IN ({marks})'
+            ' ORDER BY post_id, p.id',
+            ids
+        ).fetchall()
+
+        for comment in comments:
+            posts[comment['post_id']]['comments'].append(comment)
+
+    return posts
+
+
+def get_post_summary(id, viewer_id):
+    post = get_db().execute(
+        'SELECT p.id, title, author_id, like_count, comment_count,'
+        ' EXISTS (SELECT 1 FROM post_like l WHERE l.post_id = p.id AND l.user_id = ?) AS liked'
+        ' FROM post p WHERE p.id = ?',
+        (viewer_id, id)
+    ).fetchone()
+
+    if post is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    return post
+
+
+def load_post(id, viewer_id):
+    post = load_posts([id], viewer_id).get(id)
+
+    if post is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    return post
+
+
 @bp.route('/<int:id>/update', methods=('GET', 'POST'))
 @login_required
 def update(id):
@@ -218,15 +378,15 @@ def update(id):
                         db.rollback()
                         return redirect(request.url)
                     filename = secure_filename(file.filename)
-                    file.save(os.path.join(UPLOAD_FOLDER, filename))
+                    blob_hash = store_upload(db, file)
 
-                    db = get_db()
                     db.execute(
-                        'INSERT INTO post_image (post_id, name)'
-                        ' VALUES (?, ?)',
-                        (id, filename)
+                        'INSERT INTO post_image (post_id, name, blob_hash)'
+                        ' VALUES (?, ?, ?)',
+                        (id, filename, blob_hash)
                     )
 
+            bump_versions(db, f'post:{id}', f"author:{post['author_id']}", 'feed')
             db.commit()
             return redirect(url_for('blog.index'))
 
@@ -251,51 +411,116 @@ def make_public(id):
             ' WHERE id = ?',
             (is_public, id)
         )
+        bump_versions(db, f'post:{id}', f"author:{post['author_id']}", 'feed')
         db.commit()
     return jsonify("success")
 
 
-@bp.route('/<int:post_id>/post_like')
+@bp.route('/<int:post_id>/post_like', methods=('GET', 'POST'))
 @login_required
 def post_like(post_id):
-    like = get_post_like(post_id, g.user['id'])
+    writer = get_writer()
 
-    if like is None:
-        db = get_db()
-        db.execute(
+    if writer is not None:
+        liked = writer.toggle_like(g.user['id'], post_id)
+
+        if wants_json():
+            # the new count reaches the page through its event stream
+            return jsonify(liked=liked, queued=True), 202
+        return redirect(url_for('blog.details', id=post_id))
+
+    db = get_db()
+    try:
+        row = db.execute(
             'INSERT INTO post_like (user_id, post_id)'
-            ' VALUES (?, ?)',
+            ' VALUES (?, ?)'
+            ' ON CONFLICT (post_id, user_id) DO NOTHING',
             (g.user['id'], post_id)
         )
-        db.commit()
-    else:
-        db = get_db()
+    except sqlite3.IntegrityError:
+        abort(404, f"Post id {post_id} doesn't exist.")
+
+    liked = row.rowcount == 1
+
+    if not liked:
         db.execute('DELETE FROM post_like WHERE post_id = ? AND user_id = ?', (post_id, g.user['id'],))
-        db.commit()
 
+    bump_versions(db, f'likes:{post_id}', 'feed')
+    like_count = get_post_like_total(post_id)
+    db.commit()
+    publish_post_event(post_id, 'likes', like_count=like_count)
+
+    if wants_json():
+        return jsonify(liked=liked, like_count=like_count)
     return redirect(url_for('blog.details', id=post_id))
 
 
 @bp.route('/<int:id>/details')
+@etag_versions(lambda id: (f'post:{id}', f'comments:{id}', f'likes:{id}'))
 @login_required
 def details(id):
-    post = get_post(id, False)
-    like = get_post_like(id, g.user['id'])
-    like_total = get_post_like_total(id)
-    post_comments = get_post_comments(id)
-    post_images = get_post_images(id)
+    viewer_id = g.user['id']
+    post = get_post_summary(id, viewer_id)
+    version, comments_version = get_versions(f'post:{id}', f'comments:{id}')
+    loaded = []
+
+    def load():
+        if not loaded:
+            loaded.append(load_post(id, viewer_id))
+
+        return loaded[0]
+
+    # the like button and counters come from the summary and are never cached
+    post_body = cached_fragment(
+        ('post-body', id, version),
+        lambda: render_template('blog/_post_body.html', post=load()))
+    post_images = cached_fragment(
+        ('post-images', id, version),
+        lambda: render_template('blog/_post_images.html', images=load()['images']))
+    post_comments = cached_fragment(
+        ('post-comments', id, comments_version, viewer_id),
+        lambda: render_template('blog/_post_comments.html', post=post, page=get_comment_page(id)))
+
+    return render_template('blog/details.html', post=post, like=post['liked'], like_total=post['like_count'],
+                           post_body=post_body, post_images=post_images, post_comments=post_comments)
+
+
+@bp.route('/<int:post_id>/comments')
+@login_required
+def comments(post_id):
+    get_post_summary(post_id, g.user['id'])
+    before = request.args.get('before')
+
+    if before is not None:
+        before, = decode_cursor(before, int)
+
+    rows, older = get_comment_page(post_id, before)
+
+    return jsonify(comments=[comment_data(row) for row in rows], older=older)
 
-    return render_template('blog/details.html', post=post, like=like, like_total=like_total,
-                           post_comments=post_comments, images=post_images)
+
+@bp.route('/<int:post_id>/events')
+@login_required
+def post_events(post_id):
+    get_post_summary(post_id, g.user['id'])
+
+    return event_stream(post_id)
 
 
 @bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
-    get_post(id)
+    post = get_post(id)
     db = get_db()
+    blob_hashes = [image['blob_hash'] for image in get_post_images(id)]
+    # likes, comments and images go with it (ON DELETE CASCADE)
     db.execute('DELETE FROM post WHERE id = ?', (id,))
+    bump_versions(db, f'post:{id}', f'comments:{id}', f"author:{post['author_id']}", 'feed')
     db.commit()
+
+    for blob_hash in set(blob_hashes):
+        reclaim(db, blob_hash)
+
     return redirect(url_for('blog.index'))
 
 
@@ -303,10 +528,12 @@ def delete(id):
 @login_required
 def image_delete(post_id, image_id):
     get_post(post_id)
-    get_post_image(post_id, image_id)
+    image = get_post_image(post_id, image_id)
     db = get_db()
     db.execute('DELETE FROM post_image WHERE id = ?', (image_id,))
+    bump_versions(db, f'post:{post_id}')
     db.commit()
+    reclaim(db, image['blob_hash'])
 
     return redirect(url_for('blog.update', id=post_id))
 
@@ -324,15 +551,33 @@ def post_comment(post_id):
             error = 'Body is required.'
 
         if error is not None:
+            if wants_json():
+                return jsonify(error=error), 400
             flash(error)
+        elif get_writer() is not None:
+            get_writer().add_comment(user_id, post_id, body)
+
+            if wants_json():
+                # the comment reaches the page through its event stream
+                return jsonify(queued=True), 202
         else:
             db = get_db()
-            db.execute(
-                'INSERT INTO post_comment (user_id, post_id, body)'
-                ' VALUES (?, ?, ?)',
-                (user_id, post_id, body)
-            )
+            try:
+                comment_id = db.execute(
+                    'INSERT INTO post_comment (user_id, post_id, body)'
+                    ' VALUES (?, ?, ?)',
+                    (user_id, post_id, body)
+                ).lastrowid
+            except sqlite3.IntegrityError:
+                abort(404, f"Post id {post_id} doesn't exist.")
+            bump_versions(db, f'comments:{post_id}', 'feed')
+            comment = comment_data(get_post_comment(comment_id, post_id, user_id))
+            comment_count = get_post_summary(post_id, user_id)['comment_count']
             db.commit()
+            publish_post_event(post_id, 'comment', comment=comment, comment_count=comment_count)
+
+            if wants_json():
+                return jsonify(comment=comment, comment_count=comment_count), 201
 
     return redirect(url_for('blog.details', id=post_id))
 
@@ -344,10 +589,11 @@ def comment_delete(post_id, comment_id):
     get_post_comment(comment_id, post_id, g.user['id'])
     db = get_db()
     db.execute('DELETE FROM post_comment WHERE id = ?', (comment_id,))
+    bump_versions(db, f'comments:{post_id}', 'feed')
+    comment_count = get_post_summary(post_id, g.user['id'])['comment_count']
     db.commit()
-    return redirect(url_for('blog.details', id=post_id))
-
+    publish_post_event(post_id, 'comment-deleted', id=comment_id, comment_count=comment_count)
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    if wants_json():
+        return jsonify(id=comment_id, comment_count=comment_count)
+    return redirect(url_for('blog.details', id=post_id))
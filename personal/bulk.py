@@ -0,0 +1,383 @@
+import array
+import concurrent.futures
+import contextlib
+import csv
+import itertools
+import json
+import random
+import time
+import uuid
+
+import click
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from personal.api import normalize_timestamp
+from personal.auth import USER_UID_KEY
+from personal.db import get_db
+from personal.fixtures import words
+from personal.trending import rebuild_trending
+
+# maintained row by row these cost more than the inserts themselves, so
+# they are dropped for the load and rebuilt once at the end
+DEFERRED = (
+    'post_public_created_idx',
+    'post_author_idx',
+    'post_like_post_user_idx',
+    'post_comment_post_idx',
+    'post_like_insert',
+    'post_comment_insert',
+    'post_like_trending_insert',
+    'post_comment_trending_insert',
+    'post_fts_insert',
+)
+
+# cache keys of rows that existed before the load and gained likes,
+# comments or posts; see bump_versions() in cache.py
+LOADED_VERSIONS = (
+    "SELECT DISTINCT 'author:' || author_id, 1 FROM post WHERE id > :post AND author_id <= :user",
+    "SELECT DISTINCT 'comments:' || post_id, 1 FROM post_comment WHERE id > :comment AND post_id <= :post",
+    "SELECT DISTINCT 'likes:' || post_id, 1 FROM post_like WHERE rowid > :like AND post_id <= :post",
+    "SELECT 'feed', 1 WHERE true",
+)
+
+
+def batched(rows, size):
+    rows = iter(rows)
+
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def high_water_marks(db):
+    return db.execute(
+        'SELECT'
+        ' (SELECT COALESCE(MAX(id), 0) FROM user) AS user,'
+        ' (SELECT COALESCE(MAX(id), 0) FROM post) AS post,'
+        ' (SELECT COALESCE(MAX(id), 0) FROM post_comment) AS comment,'
+        ' (SELECT COALESCE(MAX(rowid), 0) FROM post_like) AS "like"'
+    ).fetchone()
+
+
+@contextlib.contextmanager
+def bulk_load(db):
+    """Drop the DEFERRED indexes and triggers while rows are loaded, then
+    rebuild them and catch up on what they would have done: likes are
+    deduplicated, new posts indexed for search, counters recounted,
+    trending scores recomputed and the cache versions of changed
+    pre-existing rows bumped. Runs even when the load fails part way, so
+    committed batches are left consistent.
+
+    Only for a database the app is not serving: until the load is done,
+    writes by anyone else skip the dropped triggers and reads miss the
+    dropped indexes."""
+    marks = high_water_marks(db)
+    deferred = db.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE name IN (%s)" % ', '.join('?' * len(DEFERRED)),
+        DEFERRED
+    ).fetchall()
+
+    for row in deferred:
+        db.execute(f"DROP {row['type'].upper()} {row['name']}")
+    # a crash mid-load loses at most the batch in flight, which the caller
+    # can load again
+    db.execute('PRAGMA synchronous = OFF')
+    # loaded rows only refer to parents that exist (imports join to them,
+    # seeding picks from their ids), so checking each one is wasted work
+    db.execute('PRAGMA foreign_keys = OFF')
+
+    try:
+        yield marks
+    finally:
+        db.rollback()
+        started = time.perf_counter()
+
+        duplicates = db.execute(
+            'DELETE FROM post_like WHERE rowid > ? AND rowid NOT IN'
+            ' (SELECT MIN(rowid) FROM post_like GROUP BY post_id, user_id)', (marks['like'],)
+        ).rowcount
+        if duplicates:
+            click.echo(f'Dropped {duplicates} duplicate likes.')
+        for row in deferred:
+            db.execute(row['sql'])
+
+        db.execute(
+            'INSERT INTO post_fts (rowid, title, body) SELECT id, title, body FROM post WHERE id > ?',
+            (marks['post'],)
+        )
+        for table, column in (('post_like', 'like_count'), ('post_comment', 'comment_count')):
+            db.execute(
+                f'UPDATE post SET {column} = counted.total'
+                f' FROM (SELECT post_id, COUNT(*) AS total FROM {table} GROUP BY post_id) AS counted'
+                f' WHERE post.id = counted.post_id AND post.{column} != counted.total'
+            )
+        loaded = high_water_marks(db)
+        if (loaded['like'], loaded['comment']) != (marks['like'], marks['comment']):
+            rebuild_trending(db, current_app.config['TRENDING_FLOOR'])
+        for select in LOADED_VERSIONS:
+            # the WHERE in every select keeps ON CONFLICT from parsing as a join
+            db.execute(
+                f'INSERT INTO cache_version (key, version) {select}'
+                ' ON CONFLICT (key) DO UPDATE SET version = version + 1', dict(marks)
+            )
+
+        db.commit()
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA foreign_keys = ON')
+        db.execute('PRAGMA optimize')
+        click.echo(f'Rebuilt indexes, triggers and counters in {time.perf_counter() - started:.1f}s.')
+
+
+def insert_rows(db, table, sql, rows, batch_size):
+    """executemany() ``rows`` into ``table`` one committed transaction per
+    ``batch_size`` rows, reporting the insert rate."""
+    started = time.perf_counter()
+    total = 0
+
+    for batch in batched(rows, batch_size):
+        total += db.executemany(sql, batch).rowcount
+        db.commit()
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    click.echo(f'{table}: {total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)')
+
+    return total
+
+
+def threaded_map(fn, items, workers):
+    """Lazily yield ``fn(item)`` for ``items`` in order, computed on
+    ``workers`` threads; used for password hashing, which releases the GIL."""
+    with concurrent.futures.ThreadPoolExecutor(max(workers, 1), 'bulk-hash') as executor:
+        # executor.map() alone would submit every item up front
+        for chunk in batched(items, max(workers, 1) * 64):
+            yield from executor.map(fn, chunk)
+
+
+def read_rows(file, output):
+    if output == 'csv':
+        # CSV has no NULL; empty cells are taken as missing values
+        for row in csv.DictReader(file):
+            yield {key: value if value != '' else None for key, value in row.items()}
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def normalized_rows(rows, rejected):
+    """Yield ``rows`` with their created timestamp normalized; rows whose
+    created does not parse are left out and added to ``rejected`` as
+    (row number, value)."""
+    for number, row in enumerate(rows, 1):
+        if row.get('created') is not None:
+            try:
+                row['created'] = normalize_timestamp(row['created'])
+            except ValueError:
+                rejected.append((number, row['created']))
+                continue
+
+        yield row
+
+
+def user_ids(db):
+    return {row['uuid']: row['id'] for row in db.execute('SELECT id, uuid FROM user')}
+
+
+def import_users(db, rows, batch_size, workers):
+    method = current_app.config['PASSWORD_HASH_METHOD']
+
+    def values(row):
+        pwhash = row.get('password_hash')
+        if not pwhash:
+            # '!' is not a werkzeug hash, so the account cannot log in
+            pwhash = generate_password_hash(row['password'], method) if row.get('password') else '!'
+
+        return row.get('uuid'), row['username'], pwhash
+
+    total = insert_rows(
+        db, 'user', 'INSERT INTO user (uuid, username, password) VALUES (?, ?, ?)'
+        ' ON CONFLICT (username) DO NOTHING', threaded_map(values, rows, workers), batch_size
+    )
+    # the uuid auth.register would have given them
+    db.execute('UPDATE user SET uuid = username || \'.\' || (id + ?) WHERE uuid IS NULL', (USER_UID_KEY,))
+    db.commit()
+
+    return total
+
+
+def import_posts(db, rows, batch_size):
+    users = user_ids(db)
+
+    def values():
+        for row in rows:
+            author_id = users.get(row['author'])
+            if author_id is not None:
+                yield (row.get('uuid') or str(uuid.uuid4()), author_id, as_int(row.get('is_public')),
+                       row.get('created'), row['title'], row['body'])
+
+    return insert_rows(
+        db, 'post', 'INSERT INTO post (uuid, author_id, is_public, created, title, body)'
+        ' VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?) ON CONFLICT (uuid) DO NOTHING',
+        values(), batch_size
+    )
+
+
+def import_comments(db, rows, batch_size):
+    users = user_ids(db)
+
+    return insert_rows(
+        db, 'post_comment', 'INSERT INTO post_comment (user_id, post_id, created, body)'
+        ' SELECT ?, id, COALESCE(?, CURRENT_TIMESTAMP), ? FROM post WHERE uuid = ?',
+        ((users[row['user']], row.get('created'), row['body'], row['post'])
+         for row in rows if row['user'] in users),
+        batch_size
+    )
+
+
+def import_likes(db, rows, batch_size):
+    users = user_ids(db)
+
+    return insert_rows(
+        db, 'post_like', 'INSERT INTO post_like (user_id, post_id, created)'
+        ' SELECT ?, id, COALESCE(?, CURRENT_TIMESTAMP) FROM post WHERE uuid = ?',
+        ((users[row['user']], row.get('created'), row['post']) for row in rows if row['user'] in users),
+        batch_size
+    )
+
+
+def as_int(value):
+    return None if value is None else int(value)
+
+
+@click.command('import')
+@click.argument('kind', type=click.Choice(['users', 'posts', 'comments', 'likes']))
+@click.argument('file', type=click.File('r', encoding='utf8'))
+@click.option('--format', 'output', type=click.Choice(['ndjson', 'csv']),
+              help='Defaults to csv for .csv files and ndjson otherwise.')
+@click.option('--batch', default=50000, help='Rows per transaction.')
+@click.option('--workers', default=4, help='Threads hashing plain-text passwords of users.')
+@click.confirmation_option('--offline', prompt='Is the app stopped?',
+                          help='Confirm the app is stopped.')
+def import_command(kind, file, output, batch, workers):
+    """Load rows in the format of /api/export; users need a username and a
+    password or password_hash. Rows whose user or post is unknown are skipped;
+    rows whose created is not an ISO 8601 timestamp are rejected and listed.
+    Stop the app first: indexes and triggers are dropped while rows load."""
+    output = output or ('csv' if file.name.endswith('.csv') else 'ndjson')
+    rejected = []
+    rows = normalized_rows(read_rows(file, output), rejected)
+    db = get_db()
+
+    with bulk_load(db):
+        if kind == 'users':
+            import_users(db, rows, batch, workers)
+        elif kind == 'posts':
+            import_posts(db, rows, batch)
+        elif kind == 'comments':
+            import_comments(db, rows, batch)
+        else:
+            import_likes(db, rows, batch)
+
+    if rejected:
+        click.echo(f'Rejected {len(rejected)} rows with an invalid created timestamp:')
+        for number, created in rejected[:20]:
+            click.echo(f'  row {number}: {created!r}')
+        if len(rejected) > 20:
+            click.echo('  ...')
+        raise SystemExit(1)
+
+
+def seed_timestamps(rng, days):
+    now = time.time()
+
+    while True:
+        yield time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - rng.random() * days * 86400))
+
+
+def all_ids(db, table):
+    return array.array('q', (row[0] for row in db.execute(f'SELECT id FROM {table} ORDER BY id')))
+
+
+def seed_database(users=0, posts=0, likes=0, comments=0, days=365, batch=50000,
+                  hash_each=False, workers=4, seed=1):
+    rng = random.Random(seed)
+    created = seed_timestamps(rng, days)
+    db = get_db()
+
+    with bulk_load(db) as marks:
+        if users:
+            first = marks['user'] + 1
+            method = current_app.config['PASSWORD_HASH_METHOD']
+            shared = generate_password_hash('password', method)
+
+            def values(n):
+                pwhash = generate_password_hash('password', method) if hash_each else shared
+                return n, f'seed{n}.{n + USER_UID_KEY}', f'seed{n}', pwhash
+
+            ids = range(first, first + users)
+            insert_rows(
+                db, 'user', 'INSERT INTO user (id, uuid, username, password) VALUES (?, ?, ?, ?)',
+                threaded_map(values, ids, workers) if hash_each else map(values, ids),
+                batch
+            )
+
+        user_pool = all_ids(db, 'user')
+        if (posts or likes or comments) and not user_pool:
+            raise click.ClickException('Seed some users first.')
+
+        if posts:
+            insert_rows(
+                db, 'post', 'INSERT INTO post (uuid, author_id, is_public, created, title, body)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                ((str(uuid.uuid4()), rng.choice(user_pool), int(rng.random() < 0.7),
+                  next(created), words(rng, 6), words(rng, 60)) for _ in range(posts)),
+                batch
+            )
+
+        post_pool = all_ids(db, 'post')
+        if (likes or comments) and not post_pool:
+            raise click.ClickException('Seed some posts first.')
+
+        if likes:
+            # the n-th like of a post comes from the n-th user of a per-post
+            # rotation of all users, so (post, user) pairs never repeat
+            likes = min(likes, len(post_pool) * len(user_pool))
+            insert_rows(
+                db, 'post_like', 'INSERT INTO post_like (user_id, post_id, created) VALUES (?, ?, ?)',
+                ((user_pool[(n % len(post_pool) * 7919 + n // len(post_pool)) % len(user_pool)],
+                  post_pool[n % len(post_pool)], next(created)) for n in range(likes)),
+                batch
+            )
+
+        if comments:
+            insert_rows(
+                db, 'post_comment', 'INSERT INTO post_comment (user_id, post_id, created, body)'
+                ' VALUES (?, ?, ?, ?)',
+                ((rng.choice(user_pool), rng.choice(post_pool), next(created), words(rng, 20))
+                 for _ in range(comments)),
+                batch
+            )
+
+
+@click.command('seed')
+@click.option('--users', default=0, help='Users to add; all get the password "password".')
+@click.option('--posts', default=0, help='Posts to add, by random users.')
+@click.option('--likes', default=0, help='Likes to add, spread evenly over all posts.')
+@click.option('--comments', default=0, help='Comments to add on random posts.')
+@click.option('--days', default=365, help='Spread created timestamps over this many past days.')
+@click.option('--batch', default=50000, help='Rows per transaction.')
+@click.option('--hash-each', is_flag=True,
+              help='Give every user a separately salted hash instead of sharing one.')
+@click.option('--workers', default=4, help='Threads hashing passwords with --hash-each.')
+@click.option('--seed', default=1)
+@click.confirmation_option('--offline', prompt='Is the app stopped?',
+                          help='Confirm the app is stopped.')
+def seed_command(users, posts, likes, comments, days, batch, hash_each, workers, seed):
+    """Fill the database with synthetic users, posts, likes and comments.
+    Stop the app first: indexes and triggers are dropped while rows load."""
+    seed_database(users, posts, likes, comments, days, batch, hash_each, workers, seed)
+
+
+def init_app(app):
+    app.cli.add_command(import_command)
+    app.cli.add_command(seed_command)
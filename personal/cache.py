@@ -0,0 +1,231 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, jsonify
+from markupsafe import Markup
+
+from personal.db import get_db
+
+
+class LRUCache:
+    """In-process cache bounded by entry count and per-entry age."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'type': 'lru',
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SQLiteCache:
+    """Text cache in its own SQLite file, shared by every worker process
+    on the host. Entries past their TTL are misses; the oldest ones are
+    evicted once the table holds more than ``maxsize`` rows."""
+
+    def __init__(self, path, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('PRAGMA busy_timeout = 1000')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cache_entry ('
+            ' key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_entry_expires_idx ON cache_entry (expires)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM cache_entry WHERE key = ? AND expires > ?', (key, time.time())
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        with self._lock:
+            try:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO cache_entry (key, value, expires) VALUES (?, ?, ?)',
+                    (key, value, time.time() + self.ttl)
+                )
+                self._writes += 1
+
+                if self._writes % 64 == 0:
+                    self._evict()
+            except sqlite3.OperationalError:
+                # another worker holds the write lock; caching is best effort
+                pass
+
+    def _evict(self):
+        self._db.execute('DELETE FROM cache_entry WHERE expires <= ?', (time.time(),))
+        excess = self._db.execute('SELECT COUNT(*) FROM cache_entry').fetchone()[0] - self.maxsize
+
+        if excess > 0:
+            self._db.execute(
+                'DELETE FROM cache_entry WHERE key IN'
+                ' (SELECT key FROM cache_entry ORDER BY expires LIMIT ?)', (excess,)
+            )
+            self.evictions += excess
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM cache_entry')
+
+    def stats(self):
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM cache_entry').fetchone()[0]
+
+        return {
+            'type': 'sqlite',
+            'size': size,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class NullCache:
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'type': 'null'}
+
+
+def make_cache(config):
+    kind = config['CACHE_TYPE']
+
+    if kind == 'lru':
+        return LRUCache(config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+    if kind == 'sqlite':
+        return SQLiteCache(config['CACHE_PATH'], config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+    if kind == 'null':
+        return NullCache()
+
+    raise ValueError(f'Unknown CACHE_TYPE {kind!r}.')
+
+
+def get_cache():
+    cache = current_app.extensions.get('cache')
+
+    if cache is None or cache[0] != os.getpid():
+        cache = current_app.extensions['cache'] = (os.getpid(), make_cache(current_app.config))
+
+    return cache[1]
+
+
+def get_versions(*keys):
+    """Current version of each cache key, in order; unknown keys are 0."""
+    rows = get_db().execute(
+        f"SELECT key, version FROM cache_version WHERE key IN ({', '.join('?' * len(keys))})", keys
+    ).fetchall()
+    versions = {row['key']: row['version'] for row in rows}
+
+    return tuple(versions.get(key, 0) for key in keys)
+
+
+def bump_versions(db, *keys):
+    """Invalidate every fragment built from ``keys``. Runs inside the
+    caller's transaction so readers never see new data with old versions."""
+    db.executemany(
+        'INSERT INTO cache_version (key, version) VALUES (?, 1)'
+        ' ON CONFLICT (key) DO UPDATE SET version = version + 1',
+        ((key,) for key in keys)
+    )
+
+
+def cached_fragment(key, render):
+    """Return the rendered fragment stored under ``key`` (a tuple that
+    must include every version and viewer detail the markup depends on),
+    calling ``render`` to build and store it on a miss."""
+    key = ':'.join(str(part) for part in key)
+    cache = get_cache()
+    html = cache.get(key)
+
+    if html is None:
+        html = str(render())
+        cache.set(key, html)
+
+    return Markup(html)
+
+
+def stats():
+    from personal.auth import get_user_cache
+
+    return jsonify(fragments=get_cache().stats(), users=get_user_cache().stats())
+
+
+def init_app(app):
+    from personal.auth import login_required
+
+    app.add_url_rule('/cache/stats', 'cache_stats', login_required(stats))
@@ -0,0 +1,27 @@
+import importlib
+
+import click
+
+
+class LazyGroup(click.Group):
+    """A command group imported from ``import_name`` ('module:attribute')
+    the first time one of its commands is listed or run, so processes that
+    never use it never load its module."""
+
+    def __init__(self, name, import_name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.import_name = import_name
+        self._group = None
+
+    def _load(self):
+        if self._group is None:
+            module, attribute = self.import_name.split(':')
+            self._group = getattr(importlib.import_module(module), attribute)
+
+        return self._group
+
+    def list_commands(self, ctx):
+        return self._load().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._load().get_command(ctx, name)
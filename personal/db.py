@@ -1,16 +1,194 @@
+import importlib.util
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 
 import click
 from flask import current_app, g
 
+_pool_lock = threading.Lock()
+
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_RE = re.compile(r'^(\d+)_\w+\.(sql|py)$')
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that counts and times the statements run through it.
+
+    Time is measured around execute(), which for a SELECT includes finding
+    the first row but not fetching the rest. Statements slower than
+    ``slow_query_seconds`` are kept in ``slow_queries`` (up to
+    SLOW_QUERY_LIMIT per request) for the metrics module to log."""
+
+    SLOW_QUERY_LIMIT = 50
+    slow_query_seconds = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.query_count = 0
+        self.query_time = 0.0
+        self.slow_queries = []
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._record(sql, time.perf_counter() - started)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            self._record(script, time.perf_counter() - started)
+
+    def _record(self, sql, elapsed):
+        self.query_count += 1
+        self.query_time += elapsed
+
+        if (self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds
+                and len(self.slow_queries) < self.SLOW_QUERY_LIMIT):
+            self.slow_queries.append((sql, elapsed))
+
+
+class ConnectionPool:
+    """A fixed-size pool of tuned SQLite connections shared by all threads
+    of one process. Connections are health-checked when borrowed and
+    rolled back when returned."""
+
+    def __init__(self, config):
+        self.config = config
+        self.size = config['DATABASE_POOL_SIZE']
+        self.timeout = config['DATABASE_POOL_TIMEOUT']
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        db = sqlite3.connect(
+            self.config['DATABASE'],
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=self.config['DATABASE_CACHED_STATEMENTS'],
+            factory=InstrumentedConnection,
+        )
+        db.row_factory = sqlite3.Row
+        db.slow_query_seconds = self.config['DATABASE_SLOW_QUERY_MS'] / 1000
+
+        # lets the maintenance job give freed pages back a few at a time;
+        # takes effect only in a new file, before WAL mode writes its header
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('PRAGMA busy_timeout = %d' % self.config['DATABASE_BUSY_TIMEOUT'])
+        db.execute('PRAGMA cache_size = %d' % self.config['DATABASE_CACHE_SIZE'])
+        db.execute('PRAGMA mmap_size = %d' % self.config['DATABASE_MMAP_SIZE'])
+        # deleting a post removes its likes, comments and images
+        db.execute('PRAGMA foreign_keys = ON')
+
+        return db
+
+    def acquire(self):
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            db = None
+
+        if db is None:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+
+            if can_open:
+                try:
+                    return self.connect()
+                except sqlite3.Error:
+                    self._discard()
+                    raise
+
+            try:
+                db = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise RuntimeError(
+                    f'No database connection available after {self.timeout}s.'
+                ) from None
+
+        if not self._healthy(db):
+            self._discard(db)
+            return self.acquire()
+
+        return db
+
+    def release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            self._discard(db)
+        else:
+            self._idle.put(db)
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(db)
+
+    def _healthy(self, db):
+        try:
+            db.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+
+        return True
+
+    def _discard(self, db=None):
+        with self._lock:
+            self._opened -= 1
+
+        if db is not None:
+            try:
+                db.close()
+            except sqlite3.Error:
+                pass
+
+
+def get_pool(app=None):
+    app = app or current_app
+    pool = app.extensions.get('db_pool')
+
+    # a pool inherited through fork() belongs to the parent process
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = app.extensions.get('db_pool')
+            if pool is None or pool.pid != os.getpid():
+                pool = app.extensions['db_pool'] = ConnectionPool(app.config)
+
+    return pool
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
+        g.db.reset_stats()
 
     return g.db
 
@@ -19,15 +197,136 @@ def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        get_pool().release(db)
 
 
 def init_db():
     db = get_db()
+    # dropping a table deletes its rows, which would trip the foreign keys
+    db.execute('PRAGMA foreign_keys = OFF')
 
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    # schema.sql already has everything the migrations add
+    db.executemany(
+        'INSERT INTO schema_migrations (version, name) VALUES (?, ?)',
+        [(version, name) for version, name, path in list_migrations()]
+    )
+    db.commit()
+    db.execute('PRAGMA foreign_keys = ON')
+
+
+def add_column(db, table, column, definition):
+    """Add a column unless it exists; returns whether it was added."""
+    columns = [row['name'] for row in db.execute(f'PRAGMA table_info({table})')]
+
+    if column in columns:
+        return False
+
+    db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def list_migrations():
+    """(version, name, path) of every file in migrations/, in order."""
+    migrations = []
+
+    for name in os.listdir(MIGRATIONS_FOLDER):
+        match = MIGRATION_RE.match(name)
+        if match:
+            migrations.append((int(match.group(1)), name, os.path.join(MIGRATIONS_FOLDER, name)))
+
+    return sorted(migrations)
+
+
+def migrate():
+    """Apply the migrations this database has not had yet, each in its own
+    transaction, and return their names.
+
+    A migration is either a .sql script or a .py module with an
+    ``upgrade(db)`` function. Every one must be idempotent, as databases
+    upgraded before migrations were tracked get all of them again."""
+    db = get_db()
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL,'
+        ' applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+    )
+    applied = {row[0] for row in db.execute('SELECT version FROM schema_migrations')}
+    names = []
+    # tables are rebuilt by copying them, which must neither fail on nor
+    # cascade to rows of deleted posts; the pragma is ignored in transactions
+    db.execute('PRAGMA foreign_keys = OFF')
+
+    try:
+        for version, name, path in list_migrations():
+            if version in applied:
+                continue
+
+            if name.endswith('.sql'):
+                with open(path, encoding='utf8') as f:
+                    # executescript() commits first, so the transaction is in the script
+                    db.executescript(
+                        f'BEGIN; {f.read()}\n;'
+                        f" INSERT INTO schema_migrations (version, name) VALUES ({version}, '{name}'); COMMIT;"
+                    )
+            else:
+                spec = importlib.util.spec_from_file_location(f'personal.migrations.m{version}', path)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+
+                db.execute('BEGIN')
+                try:
+                    module.upgrade(db)
+                    db.execute('INSERT INTO schema_migrations (version, name) VALUES (?, ?)', (version, name))
+                    db.commit()
+                except BaseException:
+                    db.rollback()
+                    raise
+
+            names.append(name)
+    finally:
+        db.execute('PRAGMA foreign_keys = ON')
+
+    return names
+
+
+def table_exists(db, name):
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def rebuild_search_index():
+    db = get_db()
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+    db.commit()
+
+
+def recount_posts(fix=True):
+    """Compare post.like_count/comment_count with the rows they summarize.
+
+    Returns the number of posts whose counters were wrong, correcting them
+    in the same transaction unless ``fix`` is false."""
+    db = get_db()
+    counted = (
+        ' FROM post p'
+        ' WHERE p.like_count != (SELECT COUNT(*) FROM post_like l WHERE l.post_id = p.id)'
+        ' OR p.comment_count != (SELECT COUNT(*) FROM post_comment c WHERE c.post_id = p.id)'
+    )
+    wrong = db.execute('SELECT COUNT(*)' + counted).fetchone()[0]
+
+    if fix and wrong:
+        db.execute(
+            'UPDATE post SET'
+            ' like_count = (SELECT COUNT(*) FROM post_like l WHERE l.post_id = post.id),'
+            ' comment_count = (SELECT COUNT(*) FROM post_comment c WHERE c.post_id = post.id)'
+            ' WHERE id IN (SELECT p.id' + counted + ')'
+        )
+        db.commit()
+
+    return wrong
+
 
 @click.command('init-db')
 def init_db_command():
@@ -36,6 +335,51 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations to an existing database."""
+    names = migrate()
+
+    for name in names:
+        click.echo(f'Applied {name}.')
+    click.echo(f'Applied {len(names)} migrations.' if names else 'The database is up to date.')
+
+
+@click.command('upgrade-db')
+def upgrade_db_command():
+    """Alias of migrate, kept for older deploy scripts."""
+    migrate_command.callback()
+
+
+@click.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Re-index every post for full-text search."""
+    migrate()
+    rebuild_search_index()
+    click.echo('Rebuilt the search index.')
+
+
+@click.command('recount-posts')
+@click.option('--check', is_flag=True, help='Only report wrong counters.')
+def recount_posts_command(check):
+    """Backfill and verify the like and comment counters on posts."""
+    migrate()
+    wrong = recount_posts(fix=not check)
+
+    if check:
+        click.echo(f'{wrong} posts have wrong counters.')
+        if wrong:
+            raise SystemExit(1)
+    else:
+        click.echo(f'Fixed counters on {wrong} posts.')
+        if recount_posts(fix=False):
+            raise click.ClickException('Counters still disagree after backfill.')
+
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(recount_posts_command)
+    app.cli.add_command(rebuild_search_index_command)
@@ -0,0 +1,134 @@
+import ast
+import itertools
+import os
+import re
+import sqlite3
+
+import click
+from flask import current_app
+
+from personal.db import get_db
+
+# modules whose execute() calls `flask explain` checks
+MODULES = ('blog.py', 'auth.py')
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+SCAN_RE = re.compile(r'^SCAN (\S+)')
+SUBQUERY_RE = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (\S+)')
+
+
+class QueryFinder(ast.NodeVisitor):
+    """Collects the SQL of every execute()/executemany() call of a module.
+
+    Literal strings, f-strings (each replacement field becomes one ``?``)
+    and ``+`` of those are evaluated. A local variable evaluates to each
+    value assigned to it, alone and with each ``+=`` on it appended; the
+    ``+=`` are taken as alternative branches, not applied in sequence."""
+
+    def __init__(self):
+        self.queries = []
+        self.assignments = {}
+
+    def visit_FunctionDef(self, node):
+        outer, self.assignments = self.assignments, {}
+
+        for child in ast.walk(node):
+            if isinstance(child, ast.Assign) and len(child.targets) == 1 \
+                    and isinstance(child.targets[0], ast.Name):
+                self.assignments.setdefault(child.targets[0].id, ([], []))[0].append(child.value)
+            elif isinstance(child, ast.AugAssign) and isinstance(child.op, ast.Add) \
+                    and isinstance(child.target, ast.Name):
+                self.assignments.setdefault(child.target.id, ([], []))[1].append(child.value)
+
+        self.generic_visit(node)
+        self.assignments = outer
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute) and node.func.attr in ('execute', 'executemany') and node.args:
+            for sql in self.evaluate(node.args[0]):
+                self.queries.append((node.lineno, ' '.join(sql.split())))
+
+        self.generic_visit(node)
+
+    def evaluate(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return [node.value]
+        if isinstance(node, ast.JoinedStr):
+            return [''.join(part.value if isinstance(part, ast.Constant) else '?' for part in node.values)]
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return [left + right for left, right in
+                    itertools.product(self.evaluate(node.left), self.evaluate(node.right))]
+        if isinstance(node, ast.Name) and node.id in self.assignments:
+            values, appended = self.assignments[node.id]
+            bases = [sql for value in values for sql in self.evaluate(value)]
+            tails = [''] + [sql for value in appended for sql in self.evaluate(value)]
+            return [base + tail for base in bases for tail in tails]
+
+        return []
+
+
+def find_queries(path):
+    with open(path, encoding='utf8') as f:
+        finder = QueryFinder()
+        finder.visit(ast.parse(f.read(), path))
+
+    return finder.queries
+
+
+def bad_steps(plan):
+    """The steps of ``plan`` that read a whole table or sort outside an
+    index. Scanning the rows of a subquery is fine; its own steps are
+    checked."""
+    subqueries = {match[1] for match in map(SUBQUERY_RE.match, plan) if match}
+    bad = []
+
+    for step in plan:
+        scan = SCAN_RE.match(step)
+        if scan and scan[1] not in subqueries and scan[1] != 'CONSTANT' and 'VIRTUAL TABLE' not in step \
+                or 'USE TEMP B-TREE' in step:
+            bad.append(step)
+
+    return bad
+
+
+def query_plan(db, sql):
+    parameters = STRING_RE.sub('', sql).count('?')
+    return [row[3] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * parameters)]
+
+
+@click.command('explain')
+@click.option('--live', is_flag=True,
+              help='Plan against the configured database and its statistics'
+                   ' instead of an empty one made from schema.sql.')
+@click.option('--verbose', '-v', is_flag=True, help='Print the plan of every query.')
+def explain_command(live, verbose):
+    """Check that no query of the blog and auth modules scans a whole
+    table or sorts in a temporary B-tree."""
+    if live:
+        db = get_db()
+    else:
+        db = sqlite3.connect(':memory:')
+        with current_app.open_resource('schema.sql') as f:
+            db.executescript(f.read().decode('utf8'))
+
+    failures = 0
+    for module in MODULES:
+        for lineno, sql in find_queries(os.path.join(current_app.root_path, module)):
+            try:
+                plan = query_plan(db, sql)
+            except sqlite3.Error as e:
+                plan = [f'error: {e}']
+                bad = plan
+            else:
+                bad = bad_steps(plan)
+
+            if bad or verbose:
+                click.echo(f"{'FAIL' if bad else 'ok'} {module}:{lineno} {sql}")
+                for step in plan:
+                    click.echo(f'    {step}')
+            failures += bool(bad)
+
+    if failures:
+        raise click.ClickException(f'{failures} queries scan a table, sort without an index or fail to prepare.')
+
+    click.echo('Every query uses an index.')
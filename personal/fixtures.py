@@ -0,0 +1,10 @@
+import itertools
+
+# vocabulary of generated titles, bodies and comments
+WORDS = [f'word{n}' for n in range(5000)]
+# Zipf weights so bodies look like natural text
+CUM_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+
+
+def words(rng, count):
+    return ' '.join(rng.choices(WORDS, cum_weights=CUM_WEIGHTS, k=count))
@@ -0,0 +1,103 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from personal.metrics import add_timing
+
+_pool_lock = threading.Lock()
+
+
+class HashPool:
+    """Runs password hashing on a few dedicated threads so a burst of
+    logins cannot occupy every request worker. At most ``workers`` hashes
+    run at once and ``queue_limit`` more may wait; anything beyond that is
+    refused immediately with a 503."""
+
+    def __init__(self, method, workers, queue_limit, timeout):
+        self.method = method
+        self.timeout = timeout
+        self.pid = os.getpid()
+        # hashing the empty password once gives both the canonical method
+        # prefix stored hashes are compared with and a hash of the same
+        # cost to check unknown usernames against
+        self.dummy_hash = generate_password_hash('', method)
+        self.prefix = self.dummy_hash.split('$', 1)[0]
+        self._executor = None
+        self._slots = None
+
+        if workers:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers, 'password-hash')
+            self._slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def run(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return self._run(fn, *args)
+        finally:
+            add_timing('hash', time.perf_counter() - started)
+
+    def _run(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise ServiceUnavailable('Too many sign-ins in progress, please retry.', retry_after=1)
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise ServiceUnavailable('Sign-in timed out, please retry.', retry_after=1) from None
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        # unknown users are checked against the dummy hash so the response
+        # takes as long as for a real account
+        return self.run(check_password_hash, pwhash or self.dummy_hash, password) and pwhash is not None
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.prefix
+
+
+def get_hash_pool():
+    pool = current_app.extensions.get('hash_pool')
+
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = current_app.extensions.get('hash_pool')
+            if pool is None or pool.pid != os.getpid():
+                config = current_app.config
+                pool = current_app.extensions['hash_pool'] = HashPool(
+                    config['PASSWORD_HASH_METHOD'],
+                    config['PASSWORD_HASH_WORKERS'],
+                    config['PASSWORD_HASH_QUEUE'],
+                    config['PASSWORD_HASH_TIMEOUT'],
+                )
+
+    return pool
+
+
+def hash_password(password):
+    return get_hash_pool().hash(password)
+
+
+def verify_password(pwhash, password):
+    return get_hash_pool().verify(pwhash, password)
+
+
+def needs_rehash(pwhash):
+    return get_hash_pool().needs_rehash(pwhash)
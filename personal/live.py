@@ -0,0 +1,273 @@
+import collections
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import Response, current_app, request
+
+_broker_lock = threading.Lock()
+
+
+class Subscription:
+    """Events of one channel for one stream, buffered up to ``size``. A
+    subscriber that falls that far behind is dropped; its stream ends and
+    the browser reconnects, resuming from the last event it got."""
+
+    def __init__(self, channel, size):
+        self.channel = channel
+        self.dropped = False
+        self._queue = queue.Queue(size)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LocalBackend:
+    """Delivers events straight to the subscribers of this process, and
+    keeps the last ``history`` of them for streams that resume."""
+
+    def __init__(self, history=1000):
+        # ids only have to grow, also across restarts of the process
+        self._next_id = time.time_ns() // 1000
+        self._history = collections.deque(maxlen=history)
+        self._deliver = None
+        self._lock = threading.Lock()
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, channel, data):
+        with self._lock:
+            self._next_id += 1
+            event = (self._next_id, channel, data)
+            self._history.append(event)
+
+        # nothing to deliver to until the first stream subscribes
+        if self._deliver is not None:
+            self._deliver(event)
+
+    def replay(self, channel, after_id):
+        with self._lock:
+            return [event for event in self._history if event[0] > after_id and event[1] == channel]
+
+
+class SQLiteBackend:
+    """Fans events out to every worker on the host through a change-log
+    table in its own SQLite file. Publishing appends a row; each process
+    that serves streams polls the table every ``interval`` seconds and
+    trims it to the last ``history`` rows now and then."""
+
+    def __init__(self, path, interval=0.25, history=1000):
+        self.interval = interval
+        self.history = history
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute('PRAGMA busy_timeout = 1000')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS live_event ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, data TEXT NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS live_event_channel_idx ON live_event (channel, id)')
+
+    def start(self, deliver):
+        self._deliver = deliver
+        threading.Thread(target=self._poll, name='live-poll', daemon=True).start()
+
+    def publish(self, channel, data):
+        with self._lock:
+            try:
+                self._db.execute('INSERT INTO live_event (channel, data) VALUES (?, ?)', (channel, data))
+            except sqlite3.OperationalError:
+                # another worker holds the write lock; updates are best
+                # effort and the next page load shows the change anyway
+                pass
+
+    def replay(self, channel, after_id):
+        with self._lock:
+            return self._db.execute(
+                'SELECT id, channel, data FROM live_event WHERE channel = ? AND id > ? ORDER BY id',
+                (channel, after_id)
+            ).fetchall()
+
+    def _poll(self):
+        with self._lock:
+            last_id = self._db.execute('SELECT COALESCE(MAX(id), 0) FROM live_event').fetchone()[0]
+        polls = 0
+
+        while True:
+            time.sleep(self.interval)
+            polls += 1
+
+            try:
+                with self._lock:
+                    events = self._db.execute(
+                        'SELECT id, channel, data FROM live_event WHERE id > ? ORDER BY id', (last_id,)
+                    ).fetchall()
+
+                    if polls % 100 == 0:
+                        self._db.execute('DELETE FROM live_event WHERE id <= ?', (last_id - self.history,))
+            except sqlite3.OperationalError:
+                continue
+
+            for event in events:
+                self._deliver(event)
+                last_id = event[0]
+
+
+class Broker:
+    """In-process publish/subscribe of post events, one channel per post.
+    The backend carries published events to the brokers of every process
+    that should see them, which hand them to their local subscribers."""
+
+    def __init__(self, backend, buffer=256):
+        self.backend = backend
+        self.buffer = buffer
+        self.pid = os.getpid()
+        self._subscribers = collections.defaultdict(set)
+        self._started = False
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event, **data):
+        self.backend.publish(channel, json.dumps({'event': event, **data}))
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel, self.buffer)
+
+        with self._lock:
+            # only processes that serve streams need to poll a shared backend
+            if not self._started:
+                self.backend.start(self._deliver)
+                self._started = True
+            self._subscribers[channel].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def replay(self, channel, after_id):
+        return self.backend.replay(channel, after_id)
+
+    def _deliver(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(event[1], ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+def make_backend(config):
+    kind = config['LIVE_BACKEND']
+
+    if kind == 'local':
+        return LocalBackend(config['LIVE_HISTORY'])
+    if kind == 'sqlite':
+        return SQLiteBackend(config['LIVE_PATH'], config['LIVE_POLL_INTERVAL'], config['LIVE_HISTORY'])
+
+    raise ValueError(f'Unknown LIVE_BACKEND {kind!r}.')
+
+
+def get_broker(app=None):
+    app = app or current_app
+    broker = app.extensions.get('live')
+
+    # the poll thread of a parent process does not survive fork()
+    if broker is None or broker.pid != os.getpid():
+        with _broker_lock:
+            broker = app.extensions.get('live')
+            if broker is None or broker.pid != os.getpid():
+                broker = app.extensions['live'] = Broker(make_backend(app.config))
+
+    return broker
+
+
+def post_channel(post_id):
+    return f'post:{post_id}'
+
+
+def publish_post_event(post_id, event, app=None, **data):
+    """Tell the live streams of a post about a committed change."""
+    get_broker(app).publish(post_channel(post_id), event, **data)
+
+
+def comment_data(comment):
+    """The JSON form of a comment row, as events and the API send it."""
+    return {
+        'id': comment['id'],
+        'post_id': comment['post_id'],
+        'user_id': comment['user_id'],
+        'username': comment['username'],
+        'body': comment['body'],
+        'created': comment['created'].isoformat(' '),
+    }
+
+
+def format_event(event_id, data):
+    event = json.loads(data)
+    return f"id: {event_id}\nevent: {event.pop('event')}\ndata: {json.dumps(event)}\n\n"
+
+
+def event_stream(post_id):
+    """A text/event-stream response of the events of one post.
+
+    The stream ends after LIVE_STREAM_SECONDS so no request thread is held
+    for ever; browsers reconnect on their own and send the id of the last
+    event they got, from which the stream resumes."""
+    config = current_app.config
+    broker = get_broker()
+    channel = post_channel(post_id)
+    keepalive = config['LIVE_KEEPALIVE']
+    deadline = time.monotonic() + config['LIVE_STREAM_SECONDS']
+
+    try:
+        last_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_id = None
+
+    subscription = broker.subscribe(channel)
+    missed = broker.replay(channel, last_id) if last_id is not None else []
+
+    def generate():
+        seen = last_id or 0
+
+        try:
+            yield f"retry: {config['LIVE_RETRY_MS']}\n\n"
+
+            for event_id, channel, data in missed:
+                seen = event_id
+                yield format_event(event_id, data)
+
+            while not subscription.dropped and time.monotonic() < deadline:
+                event = subscription.get(min(keepalive, max(deadline - time.monotonic(), 0)))
+
+                if event is None:
+                    yield ': keepalive\n\n'
+                elif event[0] > seen:
+                    seen = event[0]
+                    yield format_event(event[0], event[2])
+        finally:
+            broker.unsubscribe(subscription)
+
+    # the generator runs after the request context is gone, so it holds
+    # no database connection while it waits
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
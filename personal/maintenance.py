@@ -0,0 +1,230 @@
+import json
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from personal.db import get_db
+from personal.trending import rebase_trending
+
+_scheduler_lock = threading.Lock()
+
+# seconds between checks of the scheduler thread for tasks that are due
+CHECK_EVERY = 60
+
+TASKS = ('orphans', 'uploads', 'vacuum', 'optimize', 'analyze', 'trending')
+
+# tables whose rows belong to a post
+ORPHAN_TABLES = ('post_like', 'post_comment', 'post_image')
+
+
+def remove_orphans(db, batch, pause):
+    """Delete likes, comments and images whose post is gone: rows of
+    deletes made before foreign keys were enforced, or with them off.
+
+    Each table is walked by rowid, ``batch`` rowids at a time; a window
+    with orphans is deleted in its own short transaction followed by a
+    ``pause``, so other writers never wait long for the lock."""
+    removed = 0
+
+    for table in ORPHAN_TABLES:
+        top = db.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM {table}').fetchone()[0]
+
+        for start in range(0, top, batch):
+            rowids = [row[0] for row in db.execute(
+                f'SELECT rowid FROM {table} t WHERE rowid > ? AND rowid <= ?'
+                ' AND NOT EXISTS (SELECT 1 FROM post p WHERE p.id = t.post_id)',
+                (start, start + batch)
+            )]
+
+            if rowids:
+                removed += db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN ({', '.join('?' * len(rowids))})", rowids
+                ).rowcount
+                db.commit()
+                time.sleep(pause)
+
+    return {'rows': removed}
+
+
+def remove_uploads(grace):
+    from personal.uploads import gc_uploads
+
+    blobs, files, reclaimed = gc_uploads(grace)
+
+    return {'blobs': blobs, 'files': files, 'bytes': reclaimed}
+
+
+def file_pages(db):
+    return db.execute('PRAGMA page_count').fetchone()[0], db.execute('PRAGMA page_size').fetchone()[0]
+
+
+def incremental_vacuum(db, pages, pause):
+    """Give free pages back to the filesystem, ``pages`` per transaction."""
+    if db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return {'skipped': 'auto_vacuum is not incremental; run flask maintenance full-vacuum once'}
+
+    before, page_size = file_pages(db)
+    free = db.execute('PRAGMA freelist_count').fetchone()[0]
+
+    while free:
+        # execute() would step the pragma once, freeing a single page
+        db.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+        left = db.execute('PRAGMA freelist_count').fetchone()[0]
+        if left >= free:
+            break
+        free = left
+        time.sleep(pause)
+
+    after, page_size = file_pages(db)
+
+    return {'pages': before - after, 'bytes': (before - after) * page_size}
+
+
+def optimize(db):
+    db.execute('PRAGMA optimize')
+
+    return {}
+
+
+def analyze(db):
+    # samples each index instead of reading all of it
+    db.execute('PRAGMA analysis_limit = 1000')
+    db.execute('ANALYZE')
+    db.commit()
+
+    return {}
+
+
+def run_task(name):
+    """Run one maintenance task now and record what it did."""
+    config = current_app.config
+    db = get_db()
+    started = time.perf_counter()
+
+    if name == 'orphans':
+        result = remove_orphans(db, config['MAINTENANCE_BATCH'], config['MAINTENANCE_PAUSE'])
+    elif name == 'uploads':
+        result = remove_uploads(config['MAINTENANCE_UPLOAD_GRACE'])
+    elif name == 'vacuum':
+        result = incremental_vacuum(db, config['MAINTENANCE_VACUUM_PAGES'], config['MAINTENANCE_PAUSE'])
+    elif name == 'optimize':
+        result = optimize(db)
+    elif name == 'analyze':
+        result = analyze(db)
+    elif name == 'trending':
+        result = {'rows': rebase_trending(db, config['TRENDING_FLOOR'])}
+    else:
+        raise ValueError(f'Unknown maintenance task {name!r}.')
+
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    db.execute(
+        'INSERT INTO maintenance_task (name, last_run, last_result, runs, reclaimed) VALUES (?, ?, ?, 1, ?)'
+        ' ON CONFLICT (name) DO UPDATE SET last_run = excluded.last_run, last_result = excluded.last_result,'
+        ' runs = runs + 1, reclaimed = reclaimed + excluded.reclaimed',
+        (name, time.time(), json.dumps(result), result.get('bytes', 0))
+    )
+    db.commit()
+    current_app.logger.info('Maintenance %s: %s', name, result)
+
+    return result
+
+
+def claim(db, name, interval):
+    """Whether this process should run ``name`` now. The first worker to
+    find the task due moves its last run to now, so the others skip it; a
+    task never seen before is first due one interval from now."""
+    now = time.time()
+    db.execute(
+        'INSERT INTO maintenance_task (name, last_run) VALUES (?, ?) ON CONFLICT (name) DO NOTHING', (name, now)
+    )
+    claimed = db.execute(
+        'UPDATE maintenance_task SET last_run = ? WHERE name = ? AND last_run <= ?', (now, name, now - interval)
+    ).rowcount
+    db.commit()
+
+    return claimed == 1
+
+
+class Scheduler:
+    """Runs the tasks of MAINTENANCE_SCHEDULE on a background thread when
+    they are due. Every worker has one; claims in the database make sure
+    each run happens in one worker only."""
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(CHECK_EVERY)
+
+            for name, interval in self.app.config['MAINTENANCE_SCHEDULE'].items():
+                try:
+                    with self.app.app_context():
+                        if claim(get_db(), name, interval):
+                            run_task(name)
+                except Exception:
+                    self.app.logger.exception('Maintenance task %s failed', name)
+
+
+def start_scheduler():
+    app = current_app._get_current_object()
+    scheduler = app.extensions.get('maintenance')
+
+    # the thread of a parent process does not survive fork()
+    if scheduler is None or scheduler.pid != os.getpid():
+        with _scheduler_lock:
+            scheduler = app.extensions.get('maintenance')
+            if scheduler is None or scheduler.pid != os.getpid():
+                app.extensions['maintenance'] = Scheduler(app)
+
+
+maintenance = AppGroup('maintenance', help='Clean up deleted data and keep the database compact.')
+
+
+@maintenance.command('run')
+@click.argument('tasks', nargs=-1, type=click.Choice(TASKS))
+def run_command(tasks):
+    """Run maintenance tasks now, all of them by default."""
+    for name in tasks or TASKS:
+        click.echo(f'{name}: {json.dumps(run_task(name))}')
+
+
+@maintenance.command('status')
+def status_command():
+    """Show when each task last ran, what it did and the space it freed."""
+    rows = get_db().execute('SELECT * FROM maintenance_task ORDER BY name').fetchall()
+
+    for row in rows:
+        last_run = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['last_run']))
+        click.echo(f"{row['name']}: last {last_run}, {row['runs']} runs,"
+                   f" {row['reclaimed']} bytes reclaimed; last result {row['last_result'] or '-'}")
+
+    pages, page_size = file_pages(get_db())
+    free = get_db().execute('PRAGMA freelist_count').fetchone()[0]
+    click.echo(f'Database: {pages * page_size} bytes, {free * page_size} of them free.')
+
+
+@maintenance.command('full-vacuum')
+def full_vacuum_command():
+    """Rewrite the database file with VACUUM, switching it to incremental
+    auto-vacuum. Writers wait until it is done."""
+    db = get_db()
+    before, page_size = file_pages(db)
+    db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute('VACUUM')
+    after, page_size = file_pages(db)
+    click.echo(f'Reclaimed {(before - after) * page_size} bytes.')
+
+
+def init_app(app):
+    if app.config['MAINTENANCE_SCHEDULE']:
+        app.before_request(start_scheduler)
+
+    app.cli.add_command(maintenance)
@@ -0,0 +1,198 @@
+import bisect
+import hmac
+import ipaddress
+import re
+import threading
+import time
+
+from flask import Response, current_app, g, has_request_context, request, template_rendered
+from flask.signals import before_render_template
+from werkzeug.exceptions import abort
+
+# upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PLACEHOLDERS_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+SPACE_RE = re.compile(r'\s+')
+
+
+class Registry:
+    """Request metrics of this process, kept as plain sums and bucket
+    counts under one lock so recording costs a few additions. Every
+    worker process has its own; scrape them one by one."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.endpoints = {}
+        self.slow_queries = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, status, seconds, queries, query_time, template_time):
+        key = (endpoint, status // 100)
+
+        with self._lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'count': 0, 'sum': 0.0, 'queries': 0, 'query_time': 0.0, 'template_time': 0.0,
+                }
+
+            stats['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+            stats['count'] += 1
+            stats['sum'] += seconds
+            stats['queries'] += queries
+            stats['query_time'] += query_time
+            stats['template_time'] += template_time
+
+    def slow_query(self, statement, seconds):
+        with self._lock:
+            count, total = self.slow_queries.get(statement, (0, 0.0))
+            self.slow_queries[statement] = (count + 1, total + seconds)
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            endpoints = {key: {**stats, 'buckets': list(stats['buckets'])}
+                         for key, stats in self.endpoints.items()}
+            slow_queries = dict(self.slow_queries)
+
+        lines = [
+            '# HELP personal_request_duration_seconds Time from the first before_request hook to the response.',
+            '# TYPE personal_request_duration_seconds histogram',
+        ]
+        for (endpoint, status), stats in sorted(endpoints.items()):
+            labels = f'endpoint="{label(endpoint)}",status="{status}xx"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), stats['buckets']):
+                cumulative += count
+                lines.append(f'personal_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'personal_request_duration_seconds_sum{{{labels}}} {stats["sum"]}')
+            lines.append(f'personal_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+
+        for name, field, help_text in (
+            ('personal_sql_queries_total', 'queries', 'SQL statements run by requests.'),
+            ('personal_sql_seconds_total', 'query_time', 'Time requests spent executing SQL.'),
+            ('personal_template_seconds_total', 'template_time', 'Time requests spent rendering templates.'),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (endpoint, status), stats in sorted(endpoints.items()):
+                lines.append(f'{name}{{endpoint="{label(endpoint)}",status="{status}xx"}} {stats[field]}')
+
+        lines += [
+            '# HELP personal_slow_queries_total Statements slower than DATABASE_SLOW_QUERY_MS, normalized.',
+            '# TYPE personal_slow_queries_total counter',
+        ]
+        for statement, (count, total) in sorted(slow_queries.items()):
+            lines.append(f'personal_slow_queries_total{{statement="{label(statement)}"}} {count}')
+
+        lines += [
+            '# HELP personal_slow_query_seconds_total Time spent in those statements.',
+            '# TYPE personal_slow_query_seconds_total counter',
+        ]
+        for statement, (count, total) in sorted(slow_queries.items()):
+            lines.append(f'personal_slow_query_seconds_total{{statement="{label(statement)}"}} {total}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def normalize_sql(sql):
+    """Collapse a statement to its shape, so a slow query is logged and
+    counted once however its literals and IN lists vary."""
+    sql = LITERAL_RE.sub('?', sql)
+    sql = PLACEHOLDERS_RE.sub('(...)', sql)
+    return SPACE_RE.sub(' ', sql).strip()
+
+
+def get_registry():
+    return current_app.extensions['metrics']
+
+
+def add_timing(name, seconds):
+    """Add ``seconds`` to the ``name`` entry of this request's Server-Timing."""
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+def template_started(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('template_starts', []).append(time.perf_counter())
+
+
+def template_finished(sender, template, context, **extra):
+    starts = g.get('template_starts') if has_request_context() else None
+
+    if starts:
+        started = starts.pop()
+        # templates rendered while another one renders are part of its time
+        if not starts:
+            add_timing('tpl', time.perf_counter() - started)
+
+
+def record_request(response):
+    if 'request_started' not in g:
+        return response
+
+    elapsed = time.perf_counter() - g.request_started
+    timings = g.get('timings', {})
+    db = g.get('db')
+    queries, query_time = (db.query_count, db.query_time) if db is not None else (0, 0.0)
+    registry = get_registry()
+
+    for sql, seconds in db.slow_queries if db is not None else ():
+        statement = normalize_sql(sql)
+        registry.slow_query(statement, seconds)
+        current_app.logger.warning('Slow query (%.1fms) in %s: %s', seconds * 1000, request.endpoint, statement)
+
+    registry.observe(request.endpoint, response.status_code, elapsed, queries, query_time,
+                     timings.get('tpl', 0.0))
+
+    entries = [f'db;dur={query_time * 1000:.1f};desc="{queries} queries"']
+    entries += [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items()]
+    entries.append(f'total;dur={elapsed * 1000:.1f}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+
+    return response
+
+
+def is_loopback(address):
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+def metrics():
+    # endpoint names and statement shapes are not for the public: with a
+    # token set it is required, otherwise only loopback clients get in
+    token = current_app.config['METRICS_TOKEN']
+
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+    elif not is_loopback(request.remote_addr or ''):
+        abort(403)
+
+    return Response(get_registry().render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    app.extensions['metrics'] = Registry()
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+    app.add_url_rule('/metrics', 'metrics', metrics)
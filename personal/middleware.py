@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import os
+
+from flask import current_app, g, request, session
+
+from personal.assets import get_manifest
+from personal.cache import get_versions
+
+COMPRESSIBLE = {'text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript'}
+
+
+def etag_versions(keys):
+    """Declare the cache_version keys a view's output is built from.
+
+    ``keys`` is called with the view arguments and returns the keys, or
+    None to skip conditional handling for that request. The middleware
+    turns their versions into a weak ETag before the view runs."""
+    def decorator(view):
+        view.etag_versions = keys
+        return view
+
+    return decorator
+
+
+def code_fingerprint(app):
+    # templates and code change on deploy without bumping any version
+    digest = hashlib.sha1()
+
+    for directory, _, names in sorted(os.walk(app.root_path)):
+        if os.path.relpath(directory, app.root_path).startswith('static'):
+            continue
+        for name in sorted(names):
+            if name.endswith(('.py', '.html')):
+                digest.update(f'{name}:{os.path.getmtime(os.path.join(directory, name))}'.encode())
+
+    return digest.hexdigest()
+
+
+def check_etag():
+    if request.method not in ('GET', 'HEAD') or g.get('user') is None or '_flashes' in session:
+        return None
+
+    view = current_app.view_functions.get(request.endpoint)
+    keys = getattr(view, 'etag_versions', None)
+    keys = keys and keys(**request.view_args)
+
+    if not keys:
+        return None
+
+    # pages link to the bundles of the manifest, which `flask assets
+    # build` replaces without touching any code
+    parts = (
+        current_app.extensions['etag_salt'], sorted(get_manifest().items()), request.endpoint,
+        request.full_path, g.user['id'], get_versions(*keys),
+    )
+    g.etag = hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    if request.if_none_match.contains_weak(g.etag):
+        response = current_app.response_class(status=304)
+        return finish_conditional(response)
+
+    return None
+
+
+def finish_conditional(response):
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+        # pages are per viewer and must be revalidated on every use
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    return response
+
+
+def compress(response):
+    config = current_app.config
+
+    if response.mimetype not in COMPRESSIBLE:
+        return response
+
+    # whether or not this one is gzipped, a shared cache must not hand it
+    # to clients that asked with a different Accept-Encoding
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.accept_encodings):
+        return response
+
+    data = response.get_data()
+
+    if len(data) < config['GZIP_MIN_SIZE']:
+        return response
+
+    response.set_data(gzip.compress(data, config['GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+def init_app(app):
+    app.extensions['etag_salt'] = code_fingerprint(app)
+    app.before_request(check_etag)
+    app.after_request(finish_conditional)
+    app.after_request(compress)
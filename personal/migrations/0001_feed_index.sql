@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS post_public_created_idx ON post (is_public, created, id, author_id, title);
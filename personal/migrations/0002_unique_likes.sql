@@ -0,0 +1,4 @@
+-- keep the oldest of any duplicate likes so the unique index can be built
+DELETE FROM post_like WHERE rowid NOT IN (SELECT MIN(rowid) FROM post_like GROUP BY post_id, user_id);
+
+CREATE UNIQUE INDEX IF NOT EXISTS post_like_post_user_idx ON post_like (post_id, user_id);
@@ -0,0 +1,25 @@
+from personal.db import add_column
+
+
+def upgrade(db):
+    added = add_column(db, 'post', 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    added |= add_column(db, 'post', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+
+    for table, column, event, change in (
+        ('post_like', 'like_count', 'INSERT', '+ 1'),
+        ('post_like', 'like_count', 'DELETE', '- 1'),
+        ('post_comment', 'comment_count', 'INSERT', '+ 1'),
+        ('post_comment', 'comment_count', 'DELETE', '- 1'),
+    ):
+        row = 'NEW' if event == 'INSERT' else 'OLD'
+        db.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()} AFTER {event} ON {table} BEGIN'
+            f' UPDATE post SET {column} = {column} {change} WHERE id = {row}.post_id; END'
+        )
+
+    if added:
+        db.execute(
+            'UPDATE post SET'
+            ' like_count = (SELECT COUNT(*) FROM post_like l WHERE l.post_id = post.id),'
+            ' comment_count = (SELECT COUNT(*) FROM post_comment c WHERE c.post_id = post.id)'
+        )
@@ -0,0 +1,27 @@
+from personal.db import table_exists
+
+
+def upgrade(db):
+    created = not table_exists(db, 'post_fts')
+
+    db.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(title, body, content='post',"
+        " content_rowid='id', tokenize='porter unicode61')"
+    )
+    db.execute(
+        'CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN'
+        ' INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body); END'
+    )
+    db.execute(
+        'CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN'
+        " INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);"
+        ' END'
+    )
+    db.execute(
+        'CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, body ON post BEGIN'
+        " INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);"
+        ' INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body); END'
+    )
+
+    if created:
+        db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
@@ -0,0 +1 @@
+CREATE TABLE IF NOT EXISTS cache_version (key TEXT PRIMARY KEY, version INTEGER NOT NULL);
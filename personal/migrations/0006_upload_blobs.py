@@ -0,0 +1,22 @@
+from personal.db import add_column
+
+
+def upgrade(db):
+    add_column(db, 'post_image', 'blob_hash', 'TEXT NULL')
+
+    db.execute('CREATE INDEX IF NOT EXISTS post_image_blob_idx ON post_image (blob_hash)')
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS upload_blob (hash TEXT PRIMARY KEY, size INTEGER NOT NULL,'
+        ' content_type TEXT NOT NULL, refcount INTEGER NOT NULL DEFAULT 0,'
+        ' created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'
+    )
+    db.execute(
+        'CREATE TRIGGER IF NOT EXISTS post_image_insert AFTER INSERT ON post_image'
+        ' WHEN NEW.blob_hash IS NOT NULL BEGIN'
+        ' UPDATE upload_blob SET refcount = refcount + 1 WHERE hash = NEW.blob_hash; END'
+    )
+    db.execute(
+        'CREATE TRIGGER IF NOT EXISTS post_image_delete AFTER DELETE ON post_image'
+        ' WHEN OLD.blob_hash IS NOT NULL BEGIN'
+        ' UPDATE upload_blob SET refcount = refcount - 1 WHERE hash = OLD.blob_hash; END'
+    )
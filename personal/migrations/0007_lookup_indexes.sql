@@ -0,0 +1,5 @@
+-- foreign keys and lookups the blog and auth queries filter or join on
+CREATE INDEX IF NOT EXISTS user_uuid_idx ON user (uuid);
+CREATE INDEX IF NOT EXISTS post_author_idx ON post (author_id);
+CREATE INDEX IF NOT EXISTS post_comment_post_idx ON post_comment (post_id);
+CREATE INDEX IF NOT EXISTS post_image_post_idx ON post_image (post_id);
@@ -0,0 +1,58 @@
+# SQLite cannot alter a foreign key, so each table is rebuilt: copied into
+# a new one declared as in schema.sql, swapped in, and given back its
+# indexes and triggers. Rows of posts already deleted are copied as well;
+# the maintenance job removes them in small batches.
+TABLES = {
+    'post_like': (
+        'user_id INTEGER NOT NULL,'
+        ' post_id INTEGER NOT NULL,'
+        ' created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,'
+        ' FOREIGN KEY (user_id) REFERENCES user (id),'
+        ' FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE',
+        'rowid, user_id, post_id, created',
+    ),
+    'post_comment': (
+        'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' user_id INTEGER NOT NULL,'
+        ' post_id INTEGER NOT NULL,'
+        ' created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,'
+        ' body TEXT NOT NULL,'
+        ' FOREIGN KEY (user_id) REFERENCES user (id),'
+        ' FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE',
+        'id, user_id, post_id, created, body',
+    ),
+    'post_image': (
+        'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' post_id INTEGER NOT NULL,'
+        ' created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,'
+        ' name TEXT NOT NULL,'
+        ' blob_hash TEXT NULL,'
+        ' FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE',
+        'id, post_id, created, name, blob_hash',
+    ),
+}
+
+
+def cascades(db, table):
+    return any(row['table'] == 'post' and row['on_delete'] == 'CASCADE'
+               for row in db.execute(f'PRAGMA foreign_key_list({table})'))
+
+
+def upgrade(db):
+    for table, (columns, copied) in TABLES.items():
+        if cascades(db, table):
+            continue
+
+        dependents = [row[0] for row in db.execute(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger')"
+            ' AND sql IS NOT NULL', (table,)
+        )]
+
+        db.execute(f'CREATE TABLE {table}_new ({columns})')
+        # post_like keeps its rowids, which order likes by insertion
+        db.execute(f'INSERT INTO {table}_new ({copied}) SELECT {copied} FROM {table}')
+        db.execute(f'DROP TABLE {table}')
+        db.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+        for sql in dependents:
+            db.execute(sql)
@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS maintenance_task (
+  name TEXT PRIMARY KEY,
+  last_run REAL NOT NULL,
+  last_result TEXT NULL,
+  runs INTEGER NOT NULL DEFAULT 0,
+  reclaimed INTEGER NOT NULL DEFAULT 0
+);
@@ -0,0 +1,52 @@
+import time
+
+# the TRENDING_FLOOR default when this migration was written; scores
+# below it are left out of the ranking
+FLOOR = 0.01
+
+STATEMENTS = (
+    'CREATE TABLE IF NOT EXISTS trending_clock (id INTEGER PRIMARY KEY CHECK (id = 1), epoch REAL NOT NULL,'
+    ' tau REAL NOT NULL, like_weight REAL NOT NULL, comment_weight REAL NOT NULL)',
+    'INSERT OR IGNORE INTO trending_clock VALUES (1, unixepoch(), 86400 / ln(2), 1, 3)',
+    'CREATE TABLE IF NOT EXISTS post_trending (post_id INTEGER PRIMARY KEY, is_public BOOLEAN NULL,'
+    ' score REAL NOT NULL, FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE)',
+    'CREATE INDEX IF NOT EXISTS post_trending_rank_idx ON post_trending (is_public, score)',
+    'CREATE TRIGGER IF NOT EXISTS post_trending_visibility AFTER UPDATE OF is_public ON post BEGIN'
+    ' UPDATE post_trending SET is_public = NEW.is_public WHERE post_id = NEW.id; END',
+)
+
+
+def upgrade(db):
+    for statement in STATEMENTS:
+        db.execute(statement)
+
+    for table, weight in (('post_like', 'like_weight'), ('post_comment', 'comment_weight')):
+        db.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {table}_trending_insert AFTER INSERT ON {table} BEGIN'
+            ' INSERT INTO post_trending (post_id, is_public, score)'
+            f' SELECT p.id, p.is_public, c.{weight}'
+            ' * exp((COALESCE(unixepoch(NEW.created), unixepoch()) - c.epoch) / c.tau)'
+            ' FROM post p, trending_clock c WHERE p.id = NEW.post_id'
+            ' ON CONFLICT (post_id) DO UPDATE SET score = score + excluded.score; END'
+        )
+        db.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {table}_trending_delete AFTER DELETE ON {table} BEGIN'
+            f' UPDATE post_trending SET score = score - (SELECT {weight}'
+            ' * exp((COALESCE(unixepoch(OLD.created), unixepoch()) - epoch) / tau) FROM trending_clock)'
+            ' WHERE post_id = OLD.post_id; END'
+        )
+
+    # score the likes and comments already there, with the epoch at now
+    db.execute('UPDATE trending_clock SET epoch = ?', (time.time(),))
+    db.execute('DELETE FROM post_trending')
+    db.execute(
+        'INSERT INTO post_trending (post_id, is_public, score)'
+        ' SELECT p.id, p.is_public, s.score FROM ('
+        '  SELECT e.post_id,'
+        "   SUM(CASE e.kind WHEN 'like' THEN c.like_weight ELSE c.comment_weight END"
+        '       * exp((COALESCE(unixepoch(e.created), unixepoch()) - c.epoch) / c.tau)) AS score'
+        "  FROM (SELECT post_id, created, 'like' AS kind FROM post_like"
+        "        UNION ALL SELECT post_id, created, 'comment' FROM post_comment) e, trending_clock c"
+        '  GROUP BY e.post_id'
+        ' ) s JOIN post p ON p.id = s.post_id WHERE s.score >= ?', (FLOOR,)
+    )
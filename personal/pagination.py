@@ -0,0 +1,51 @@
+import base64
+import binascii
+
+from werkzeug.exceptions import abort
+
+SEPARATOR = '\x1f'
+
+
+def encode_cursor(*values):
+    raw = SEPARATOR.join(str(value) for value in values)
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, *types):
+    """Split a cursor made by encode_cursor back into its parts, converting
+    each with the matching entry of ``types``. Aborts with 400 when the
+    token was tampered with."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf8')
+        values = raw.split(SEPARATOR)
+
+        if len(values) != len(types):
+            raise ValueError(token)
+
+        return [convert(value) for convert, value in zip(types, values)]
+    except (binascii.Error, ValueError):
+        abort(400, 'Invalid page cursor.')
+
+
+def keyset_page(rows, limit, key, after=None, before=None):
+    """Trim a ``limit + 1`` keyset query result to one page.
+
+    Returns ``(rows, next_cursor, prev_cursor)`` with rows in display order.
+    When ``before`` is given the query walked towards newer rows and so
+    returned them in reverse order."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if before is not None:
+        rows.reverse()
+
+    if not rows:
+        return rows, None, None
+
+    has_next = has_more if before is None else True
+    has_prev = has_more if before is not None else after is not None
+
+    next_cursor = encode_cursor(*key(rows[-1])) if has_next else None
+    prev_cursor = encode_cursor(*key(rows[0])) if has_prev else None
+
+    return rows, next_cursor, prev_cursor
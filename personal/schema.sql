@@ -3,6 +3,13 @@ DROP TABLE IF EXISTS post;
 DROP TABLE IF EXISTS post_like;
 DROP TABLE IF EXISTS post_comment;
 DROP TABLE IF EXISTS post_image;
+DROP TABLE IF EXISTS post_fts;
+DROP TABLE IF EXISTS cache_version;
+DROP TABLE IF EXISTS upload_blob;
+DROP TABLE IF EXISTS schema_migrations;
+DROP TABLE IF EXISTS maintenance_task;
+DROP TABLE IF EXISTS trending_clock;
+DROP TABLE IF EXISTS post_trending;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -11,6 +18,8 @@ CREATE TABLE user (
   password TEXT NOT NULL
 );
 
+CREATE INDEX user_uuid_idx ON user (uuid);
+
 CREATE TABLE post (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   uuid TEXT UNIQUE NOT NULL,
@@ -19,17 +28,25 @@ CREATE TABLE post (
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   title TEXT NOT NULL,
   body TEXT NOT NULL,
+  like_count INTEGER NOT NULL DEFAULT 0,
+  comment_count INTEGER NOT NULL DEFAULT 0,
   FOREIGN KEY (author_id) REFERENCES user (id)
 );
 
+-- covers the public feed so its keyset pages never touch the post table
+CREATE INDEX post_public_created_idx ON post (is_public, created, id, author_id, title);
+CREATE INDEX post_author_idx ON post (author_id);
+
 CREATE TABLE post_like (
   user_id INTEGER NOT NULL,
   post_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   FOREIGN KEY (user_id) REFERENCES user (id),
-  FOREIGN KEY (post_id) REFERENCES post (id)
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
 );
 
+CREATE UNIQUE INDEX post_like_post_user_idx ON post_like (post_id, user_id);
+
 CREATE TABLE post_comment (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   user_id INTEGER NOT NULL,
@@ -37,13 +54,154 @@ CREATE TABLE post_comment (
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   body TEXT NOT NULL,
   FOREIGN KEY (user_id) REFERENCES user (id),
-  FOREIGN KEY (post_id) REFERENCES post (id)
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
 );
 
+CREATE INDEX post_comment_post_idx ON post_comment (post_id);
+
 CREATE TABLE post_image (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   post_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   name TEXT NOT NULL,
-  FOREIGN KEY (post_id) REFERENCES post (id)
-);
\ No newline at end of file
+  blob_hash TEXT NULL,
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
+);
+
+CREATE INDEX post_image_post_idx ON post_image (post_id);
+CREATE INDEX post_image_blob_idx ON post_image (blob_hash);
+
+-- uploaded files, stored once per sha256 and shared by every post_image
+-- row that references them
+CREATE TABLE upload_blob (
+  hash TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  content_type TEXT NOT NULL,
+  refcount INTEGER NOT NULL DEFAULT 0,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER post_image_insert AFTER INSERT ON post_image WHEN NEW.blob_hash IS NOT NULL BEGIN
+  UPDATE upload_blob SET refcount = refcount + 1 WHERE hash = NEW.blob_hash;
+END;
+
+CREATE TRIGGER post_image_delete AFTER DELETE ON post_image WHEN OLD.blob_hash IS NOT NULL BEGIN
+  UPDATE upload_blob SET refcount = refcount - 1 WHERE hash = OLD.blob_hash;
+END;
+
+-- versions of migrations/ this database has; init-db records all of them
+CREATE TABLE schema_migrations (
+  version INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- when each background maintenance task last ran, across all workers,
+-- what it did and how many bytes its runs have freed in total
+CREATE TABLE maintenance_task (
+  name TEXT PRIMARY KEY,
+  last_run REAL NOT NULL,
+  last_result TEXT NULL,
+  runs INTEGER NOT NULL DEFAULT 0,
+  reclaimed INTEGER NOT NULL DEFAULT 0
+);
+
+-- bumped by every write so cached fragments built from older data are never served
+CREATE TABLE cache_version (
+  key TEXT PRIMARY KEY,
+  version INTEGER NOT NULL
+);
+
+-- post.like_count and post.comment_count are maintained here so they stay
+-- exact whichever code path inserts or deletes the rows
+CREATE TRIGGER post_like_insert AFTER INSERT ON post_like BEGIN
+  UPDATE post SET like_count = like_count + 1 WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER post_like_delete AFTER DELETE ON post_like BEGIN
+  UPDATE post SET like_count = like_count - 1 WHERE id = OLD.post_id;
+END;
+
+CREATE TRIGGER post_comment_insert AFTER INSERT ON post_comment BEGIN
+  UPDATE post SET comment_count = comment_count + 1 WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER post_comment_delete AFTER DELETE ON post_comment BEGIN
+  UPDATE post SET comment_count = comment_count - 1 WHERE id = OLD.post_id;
+END;
+
+-- time-decayed popularity of posts. Scores use forward decay: a like or
+-- comment made at time t adds weight * exp((t - epoch) / tau) and is never
+-- touched again, which ranks newer events higher exactly as decaying all
+-- scores would. The maintenance job moves the epoch forward now and then,
+-- scaling the scores down to match, before they grow too big.
+CREATE TABLE trending_clock (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  epoch REAL NOT NULL,
+  tau REAL NOT NULL,
+  like_weight REAL NOT NULL,
+  comment_weight REAL NOT NULL
+);
+
+-- a half-life of one day
+INSERT INTO trending_clock VALUES (1, unixepoch(), 86400 / ln(2), 1, 3);
+
+CREATE TABLE post_trending (
+  post_id INTEGER PRIMARY KEY,
+  is_public BOOLEAN NULL,
+  score REAL NOT NULL,
+  FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE
+);
+
+-- blog.trending reads the top of this in order
+CREATE INDEX post_trending_rank_idx ON post_trending (is_public, score);
+
+CREATE TRIGGER post_like_trending_insert AFTER INSERT ON post_like BEGIN
+  INSERT INTO post_trending (post_id, is_public, score)
+  SELECT p.id, p.is_public, c.like_weight * exp((COALESCE(unixepoch(NEW.created), unixepoch()) - c.epoch) / c.tau)
+  FROM post p, trending_clock c WHERE p.id = NEW.post_id
+  ON CONFLICT (post_id) DO UPDATE SET score = score + excluded.score;
+END;
+
+-- scores below TRENDING_FLOOR are dropped, so removing an event only
+-- updates a row that is still there
+CREATE TRIGGER post_like_trending_delete AFTER DELETE ON post_like BEGIN
+  UPDATE post_trending SET score = score - (
+    SELECT like_weight * exp((COALESCE(unixepoch(OLD.created), unixepoch()) - epoch) / tau) FROM trending_clock
+  ) WHERE post_id = OLD.post_id;
+END;
+
+CREATE TRIGGER post_comment_trending_insert AFTER INSERT ON post_comment BEGIN
+  INSERT INTO post_trending (post_id, is_public, score)
+  SELECT p.id, p.is_public, c.comment_weight * exp((COALESCE(unixepoch(NEW.created), unixepoch()) - c.epoch) / c.tau)
+  FROM post p, trending_clock c WHERE p.id = NEW.post_id
+  ON CONFLICT (post_id) DO UPDATE SET score = score + excluded.score;
+END;
+
+CREATE TRIGGER post_comment_trending_delete AFTER DELETE ON post_comment BEGIN
+  UPDATE post_trending SET score = score - (
+    SELECT comment_weight * exp((COALESCE(unixepoch(OLD.created), unixepoch()) - epoch) / tau) FROM trending_clock
+  ) WHERE post_id = OLD.post_id;
+END;
+
+CREATE TRIGGER post_trending_visibility AFTER UPDATE OF is_public ON post BEGIN
+  UPDATE post_trending SET is_public = NEW.is_public WHERE post_id = NEW.id;
+END;
+
+-- full-text index over post titles and bodies, kept in sync incrementally
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, content='post', content_rowid='id', tokenize='porter unicode61'
+);
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body ON post BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
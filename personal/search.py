@@ -0,0 +1,65 @@
+import re
+
+from flask import Blueprint, current_app, g, render_template, request
+from markupsafe import Markup, escape
+
+from personal.auth import login_required
+from personal.db import get_db
+from personal.pagination import decode_cursor, keyset_page
+
+bp = Blueprint('search', __name__)
+
+# snippet() wraps matches in these so they survive HTML escaping
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+@bp.route('/search')
+@login_required
+def index():
+    query = request.args.get('q', '').strip()
+    after = request.args.get('after')
+    posts, next_cursor = [], None
+
+    if query:
+        posts, next_cursor = search_posts(query, g.user['id'], after)
+
+    return render_template('blog/search.html', query=query, posts=posts, next_cursor=next_cursor)
+
+
+def match_expression(query):
+    # quote every term so user input can never be parsed as FTS5 syntax
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def search_posts(query, viewer_id, after=None, limit=None):
+    """Rank the posts ``viewer_id`` may see against ``query`` with bm25,
+    weighting title matches above body matches.
+
+    Pages are keyset-paginated on (score, id); returns the page of rows
+    and the cursor of the next one."""
+    limit = limit or current_app.config['POSTS_PER_PAGE']
+    sql = (
+        'SELECT p.id, p.title, p.created, p.author_id, u.username, f.rank AS score,'
+        " snippet(post_fts, -1, char(2), char(3), '…', 24) AS snippet"
+        ' FROM post_fts f JOIN post p ON p.id = f.rowid JOIN user u ON p.author_id = u.id'
+        " WHERE post_fts MATCH ? AND f.rank MATCH 'bm25(10.0, 1.0)'"
+        ' AND (p.is_public = 1 OR p.author_id = ?)'
+    )
+    params = (match_expression(query), viewer_id)
+
+    if after is not None:
+        sql += ' AND (f.rank, f.rowid) > (?, ?)'
+        params += tuple(decode_cursor(after, float, int))
+
+    rows = get_db().execute(sql + ' ORDER BY f.rank, f.rowid LIMIT ?', params + (limit + 1,)).fetchall()
+    rows, next_cursor, _ = keyset_page(rows, limit, lambda row: (row['score'], row['id']), after=after)
+
+    return [dict(row, snippet=highlight(row['snippet'])) for row in rows], next_cursor
+
+
+def highlight(snippet):
+    text = str(escape(TAG_RE.sub('', snippet)))
+
+    return Markup(text.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
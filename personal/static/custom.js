@@ -1,3 +1,104 @@
  $(document).ready(function() {
 
- });
\ No newline at end of file
+ });
+
+// keeps the comments and likes of a details page up to date without reloads
+function livePost(eventsUrl, commentsUrl) {
+    var $comments = $('#post-comments');
+    var userId = $comments.data('user-id');
+
+    function renderComment(comment) {
+        var $comment = $('<div class="comment">').attr('id', 'comment-' + comment.id);
+        var $about = $('<div class="about">').append($('<small>').text(comment.created.slice(0, 10)));
+
+        if (comment.user_id === userId) {
+            $about.append($('<form class="float-right comment-delete" method="post">')
+                .attr('action', $SCRIPT_ROOT + '/' + comment.post_id + '/' + comment.id + '/comment_delete')
+                .append('<button onclick="return confirm(\'Are you sure?\');" type="submit" class="btn btn-danger">'
+                        + '<i class="bi bi-exclamation-octagon"></i></button>'));
+        }
+
+        return $comment.append($('<h5>').append($('<strong>').text(comment.username)),
+                               $('<p class="body">').text(comment.body), $about);
+    }
+
+    function addComment(comment) {
+        if (!$('#comment-' + comment.id).length) {
+            $comments.append(renderComment(comment));
+        }
+    }
+
+    function setLiked(liked) {
+        $('#post-like i').attr('class', liked ? 'fa bi-hand-thumbs-down-fill' : 'bi bi-hand-thumbs-up-fill');
+    }
+
+    var source = new EventSource(eventsUrl);
+
+    source.addEventListener('comment', function(e) {
+        var data = JSON.parse(e.data);
+        addComment(data.comment);
+        $('#comment-count').text(data.comment_count);
+    });
+    source.addEventListener('comment-deleted', function(e) {
+        var data = JSON.parse(e.data);
+        $('#comment-' + data.id).remove();
+        $('#comment-count').text(data.comment_count);
+    });
+    source.addEventListener('likes', function(e) {
+        $('#post-like .like-count').text(JSON.parse(e.data).like_count);
+    });
+
+    $('#post-like').click(function(e) {
+        e.preventDefault();
+        $.ajax({type: 'POST', url: this.href, dataType: 'json', success: function(res) {
+            setLiked(res.liked);
+            if (res.like_count !== undefined) {
+                $('#post-like .like-count').text(res.like_count);
+            }
+        }});
+    });
+
+    $('#comment-form').submit(function(e) {
+        var $form = $(this);
+        e.preventDefault();
+        $.ajax({
+            type: 'POST', url: $form.attr('action'), data: $form.serialize(), dataType: 'json',
+            success: function(res) {
+                $form.find('textarea').val('');
+                if (res.comment) {
+                    addComment(res.comment);
+                    $('#comment-count').text(res.comment_count);
+                }
+            },
+            error: function(xhr) {
+                alert((xhr.responseJSON && xhr.responseJSON.error) || 'The comment could not be saved.');
+            }
+        });
+    });
+
+    $comments.on('submit', '.comment-delete', function(e) {
+        var $form = $(this);
+        e.preventDefault();
+        $.ajax({type: 'POST', url: $form.attr('action'), dataType: 'json', success: function(res) {
+            $('#comment-' + res.id).remove();
+            $('#comment-count').text(res.comment_count);
+        }});
+    });
+
+    $comments.on('click', '.load-older', function() {
+        var $button = $(this);
+        $.getJSON(commentsUrl, {before: $button.attr('data-cursor')}, function(res) {
+            // inserted newest first right after the button, so they end up in order
+            $.each(res.comments.reverse(), function(i, comment) {
+                if (!$('#comment-' + comment.id).length) {
+                    $button.after(renderComment(comment));
+                }
+            });
+            if (res.older) {
+                $button.attr('data-cursor', res.older);
+            } else {
+                $button.remove();
+            }
+        });
+    });
+}
@@ -0,0 +1,120 @@
+import math
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from personal.db import get_db
+
+# every post's score computed from all its likes and comments, in the
+# units of the current epoch; post_trending holds the same numbers kept
+# up to date by triggers (see schema.sql)
+SCORES = (
+    'SELECT e.post_id,'
+    " SUM(CASE e.kind WHEN 'like' THEN c.like_weight ELSE c.comment_weight END"
+    '     * exp((COALESCE(unixepoch(e.created), unixepoch()) - c.epoch) / c.tau)) AS score'
+    ' FROM (SELECT post_id, created, \'like\' AS kind FROM post_like'
+    "       UNION ALL SELECT post_id, created, 'comment' FROM post_comment) e, trending_clock c"
+    ' GROUP BY e.post_id'
+)
+
+
+def rebuild_trending(db, floor, half_life=None, like_weight=None, comment_weight=None):
+    """Recompute every score from scratch with the epoch moved to now,
+    changing the half-life (in seconds) and weights when given. Scores
+    below ``floor`` are left out. Does not commit."""
+    clock = db.execute('SELECT * FROM trending_clock').fetchone()
+    db.execute(
+        'UPDATE trending_clock SET epoch = ?, tau = ?, like_weight = ?, comment_weight = ?',
+        (time.time(),
+         clock['tau'] if half_life is None else half_life / math.log(2),
+         clock['like_weight'] if like_weight is None else like_weight,
+         clock['comment_weight'] if comment_weight is None else comment_weight)
+    )
+    db.execute('DELETE FROM post_trending')
+
+    return db.execute(
+        'INSERT INTO post_trending (post_id, is_public, score)'
+        f' SELECT s.post_id, p.is_public, s.score FROM ({SCORES}) s JOIN post p ON p.id = s.post_id'
+        ' WHERE s.score >= ?', (floor,)
+    ).rowcount
+
+
+def rebase_trending(db, floor):
+    """Move the epoch to now, scaling every score down by the decay since
+    the last move so rankings are unchanged, and drop the scores that have
+    decayed below ``floor``. Keeps the numbers, which grow exponentially
+    with time since the epoch, far from overflowing. Commits."""
+    now = time.time()
+    db.execute(
+        'UPDATE post_trending SET score = score * exp((c.epoch - ?) / c.tau) FROM trending_clock c', (now,)
+    )
+    db.execute('UPDATE trending_clock SET epoch = ?', (now,))
+    pruned = db.execute('DELETE FROM post_trending WHERE score < ?', (floor,)).rowcount
+    db.commit()
+
+    return pruned
+
+
+def check_trending(db, floor):
+    """Compare post_trending with a full recompute. Returns the ids of
+    posts whose stored score or visibility is wrong.
+
+    Scores dropped for being below ``floor`` are gone from the table but
+    still part of the recompute, so differences up to ``floor`` are
+    expected."""
+    rows = db.execute(
+        f'WITH expected AS ({SCORES})'
+        ' SELECT p.id, p.is_public, t.is_public AS ranked_public, COALESCE(t.score, 0) AS stored,'
+        ' COALESCE(e.score, 0) AS expected'
+        ' FROM post p LEFT JOIN expected e ON e.post_id = p.id LEFT JOIN post_trending t ON t.post_id = p.id'
+        ' WHERE e.post_id IS NOT NULL OR t.post_id IS NOT NULL'
+    ).fetchall()
+
+    return [
+        row['id'] for row in rows
+        if abs(row['stored'] - row['expected']) > floor + 1e-9 * abs(row['expected'])
+        or (row['stored'] and row['ranked_public'] != row['is_public'])
+    ]
+
+
+trending = AppGroup('trending', help='Maintain the trending posts ranking.')
+
+
+@trending.command('rebuild')
+@click.option('--half-life', type=float, help='Hours for a like or comment to lose half its weight.')
+@click.option('--like-weight', type=float, help='Score of a like when it is new.')
+@click.option('--comment-weight', type=float, help='Score of a comment when it is new.')
+def rebuild_command(half_life, like_weight, comment_weight):
+    """Recompute every trending score, optionally with a new half-life
+    and weights."""
+    db = get_db()
+    ranked = rebuild_trending(db, current_app.config['TRENDING_FLOOR'],
+                              half_life and half_life * 3600, like_weight, comment_weight)
+    db.commit()
+    click.echo(f'Ranked {ranked} posts.')
+
+
+@trending.command('check')
+@click.option('--fix', is_flag=True, help='Rebuild the ranking when it is wrong.')
+def check_command(fix):
+    """Compare the trending scores with a full recompute."""
+    db = get_db()
+    floor = current_app.config['TRENDING_FLOOR']
+    wrong = check_trending(db, floor)
+
+    click.echo(f'{len(wrong)} posts have wrong trending scores.')
+    if wrong:
+        click.echo('Posts: ' + ', '.join(map(str, wrong[:20])) + (' ...' if len(wrong) > 20 else ''))
+
+        if fix:
+            rebuild_trending(db, floor)
+            db.commit()
+            click.echo('Rebuilt the ranking.')
+        else:
+            raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(trending)
@@ -0,0 +1,235 @@
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+import time
+
+import click
+from flask import Blueprint, Request, current_app, g, make_response, send_file, url_for
+from werkzeug.exceptions import RequestEntityTooLarge, abort
+
+from personal.db import get_db
+
+bp = Blueprint('uploads', __name__)
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 64 * 1024
+
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+# the only types blobs are served as; anything else stored by an older
+# version goes out as a download
+SERVED_TYPES = {mimetypes.guess_type(f'upload.{extension}')[0] for extension in ALLOWED_EXTENSIONS}
+
+
+class HashingFile:
+    """Temporary file that hashes and size-checks uploaded bytes as the
+    form parser streams them in, so blobs are hashed in a single pass."""
+
+    def __init__(self, directory, limit):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix='upload-')
+        self.file = os.fdopen(fd, 'w+b')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.limit = limit
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.size > self.limit:
+            raise RequestEntityTooLarge()
+
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class UploadRequest(Request):
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        config = current_app.config
+        stream = HashingFile(temp_folder(), config['UPLOAD_MAX_BYTES'])
+        g.setdefault('upload_temp_files', []).append(stream)
+
+        return stream
+
+
+def temp_folder():
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+
+def blob_path(blob_hash):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], blob_hash[:2], blob_hash[2:4], blob_hash)
+
+
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def store_upload(db, file):
+    """Store an uploaded FileStorage once by content hash and return the
+    hash. The blob row is written in the caller's transaction; inserting a
+    post_image that references it takes the reference (see schema.sql).
+
+    The content type comes from the file's extension, which the caller
+    has checked with allowed_file(), never from what the client sent."""
+    stream = file.stream
+
+    if not isinstance(stream, HashingFile):
+        stream = HashingFile(temp_folder(), current_app.config['UPLOAD_MAX_BYTES'])
+        g.setdefault('upload_temp_files', []).append(stream)
+        for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+            stream.write(chunk)
+
+    stream.flush()
+    blob_hash = stream.sha256.hexdigest()
+
+    # taking the write lock before touching the file serializes this with
+    # reclaim(), which deletes the file under the same lock
+    db.execute(
+        'INSERT INTO upload_blob (hash, size, content_type) VALUES (?, ?, ?)'
+        ' ON CONFLICT (hash) DO NOTHING',
+        (blob_hash, stream.size, mimetypes.guess_type(file.filename)[0] or 'application/octet-stream')
+    )
+
+    path = blob_path(blob_hash)
+    if os.path.exists(path):
+        os.unlink(stream.path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(stream.path, path)
+
+    return blob_hash
+
+
+def reclaim(db, blob_hash):
+    """Delete a blob nothing references any more. Commits."""
+    if blob_hash is None:
+        return
+
+    deleted = db.execute(
+        'DELETE FROM upload_blob WHERE hash = ? AND refcount <= 0', (blob_hash,)
+    ).rowcount
+
+    if deleted:
+        try:
+            os.unlink(blob_path(blob_hash))
+        except FileNotFoundError:
+            pass
+
+    db.commit()
+
+
+def image_url(image):
+    if image['blob_hash']:
+        return url_for('uploads.serve', blob_hash=image['blob_hash'])
+
+    # images uploaded before the blob store lived under static/
+    return url_for('static', filename='uploads/' + image['name'])
+
+
+@bp.route('/uploads/<blob_hash>')
+def serve(blob_hash):
+    if not HASH_RE.match(blob_hash):
+        abort(404)
+
+    blob = get_db().execute(
+        'SELECT content_type FROM upload_blob WHERE hash = ?', (blob_hash,)
+    ).fetchone()
+
+    if blob is None:
+        abort(404)
+
+    path = blob_path(blob_hash)
+    accel_prefix = current_app.config['UPLOAD_ACCEL_REDIRECT']
+    content_type = blob['content_type']
+    if content_type not in SERVED_TYPES:
+        content_type = 'application/octet-stream'
+
+    if accel_prefix:
+        # let nginx send the bytes; it handles Range and conditionals itself
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + os.path.relpath(
+            path, current_app.config['UPLOAD_FOLDER'])
+        response.headers['Content-Type'] = content_type
+        response.set_etag(blob_hash)
+    else:
+        # send_file honours USE_X_SENDFILE, Range and If-None-Match
+        response = send_file(path, mimetype=content_type, etag=blob_hash,
+                             conditional=True, max_age=365 * 24 * 3600)
+
+    # browsers must not guess a more dangerous type from the bytes
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+
+    return response
+
+
+def remove_temp_files(e=None):
+    for stream in g.pop('upload_temp_files', ()):
+        stream.file.close()
+        try:
+            os.unlink(stream.path)
+        except FileNotFoundError:
+            pass
+
+
+def gc_uploads(grace=3600):
+    """Recount blob references, then delete unreferenced blobs and any
+    file under UPLOAD_FOLDER that no blob row owns. Files younger than
+    ``grace`` seconds are left alone as they may belong to an upload that
+    has not committed yet. Returns (blobs, files, bytes) removed."""
+    db = get_db()
+    db.execute(
+        'UPDATE upload_blob SET refcount ='
+        ' (SELECT COUNT(*) FROM post_image WHERE blob_hash = upload_blob.hash)'
+    )
+    db.commit()
+
+    blobs = reclaimed = 0
+    for row in db.execute('SELECT hash, size FROM upload_blob WHERE refcount <= 0').fetchall():
+        reclaim(db, row['hash'])
+        blobs += 1
+        reclaimed += row['size']
+
+    files = 0
+    cutoff = time.time() - grace
+    for directory, _, names in os.walk(current_app.config['UPLOAD_FOLDER']):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.getmtime(path) > cutoff:
+                continue
+
+            if HASH_RE.match(name) and db.execute(
+                'SELECT 1 FROM upload_blob WHERE hash = ?', (name,)
+            ).fetchone():
+                continue
+
+            reclaimed += os.path.getsize(path)
+            os.unlink(path)
+            files += 1
+
+    return blobs, files, reclaimed
+
+
+@click.command('gc-uploads')
+@click.option('--grace', default=3600, help='Keep files younger than this many seconds.')
+def gc_uploads_command(grace):
+    """Delete uploaded blobs that no post image references."""
+    blobs, files, reclaimed = gc_uploads(grace)
+    click.echo(f'Removed {blobs} blobs and {files} orphaned files, {reclaimed} bytes.')
+
+
+def init_app(app):
+    app.request_class = UploadRequest
+    app.teardown_request(remove_temp_files)
+    app.add_template_global(image_url)
+    app.register_blueprint(bp)
+    app.cli.add_command(gc_uploads_command)
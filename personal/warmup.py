@@ -0,0 +1,75 @@
+import gc
+import os
+import time
+
+import click
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+
+def compile_templates(app):
+    """Load every template into the environment's cache, writing its
+    bytecode to TEMPLATE_CACHE_DIR. Returns the number of templates."""
+    names = app.jinja_env.list_templates(extensions=('html',))
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+def warm_up(app):
+    """Do the work of a worker's first requests once, in the process that
+    loads the app before forking, so every worker starts with it done and
+    shares the memory copy-on-write."""
+    from personal.assets import get_manifest
+
+    compile_templates(app)
+
+    with app.app_context():
+        get_manifest()
+
+    # SQLite connections must not cross fork(), so the pool is closed
+    # again and SQLite's own cache goes with it; what stays is the OS page
+    # cache, shared by every worker, holding the pages first requests read
+    with app.app_context():
+        warm_pages()
+    app.extensions.pop('db_pool').close()
+
+    # keep the collector from touching, and so copying, these objects
+    gc.freeze()
+
+
+def warm_pages():
+    """Read what the first requests of a worker read: the first page of
+    the feed with its batched stats, the top of the trending ranking, and
+    all of post_public_created_idx, which every feed page walks."""
+    from personal.blog import get_public_posts, get_trending_posts, load_posts
+    from personal.db import get_db
+
+    posts = get_public_posts()[0] + get_trending_posts()
+    load_posts({post['id'] for post in posts}, None)
+    get_db().execute(
+        'SELECT COUNT(*) FROM post INDEXED BY post_public_created_idx WHERE is_public = 1'
+    ).fetchone()
+
+
+@click.command('precompile-templates')
+def precompile_templates_command():
+    """Compile every template into the bytecode cache."""
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set.')
+
+    started = time.perf_counter()
+    count = compile_templates(current_app)
+    click.echo(f'Compiled {count} templates in {time.perf_counter() - started:.2f}s.')
+
+
+def init_app(app):
+    directory = app.config['TEMPLATE_CACHE_DIR']
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    app.cli.add_command(precompile_templates_command)
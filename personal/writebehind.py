@@ -0,0 +1,242 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+from personal.cache import bump_versions
+from personal.db import get_db, get_pool
+from personal.live import comment_data, publish_post_event
+
+_writer_lock = threading.Lock()
+
+# these queue intents instead of reading, so they need not wait for the
+# user's earlier ones to be applied
+WRITE_ENDPOINTS = {'blog.post_like', 'blog.post_comment'}
+
+
+class WriteBehind:
+    """Applies like toggles and comments on a background thread, many per
+    transaction, so bursts of them share one commit.
+
+    Toggles are resolved to the state the user asked for when they are
+    queued, so repeated toggles of one (user, post) within a window
+    coalesce into a single insert or delete. Every intent gets a sequence
+    number; readers wait until the last one of their own user has been
+    applied, which keeps writes visible to the user who made them."""
+
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.pid = os.getpid()
+        self.batch_size = config['WRITE_BEHIND_BATCH']
+        self.interval = config['WRITE_BEHIND_INTERVAL']
+        self.wait_timeout = config['WRITE_BEHIND_WAIT']
+        self.batches = 0
+        self._queue = queue.Queue(config['WRITE_BEHIND_QUEUE'])
+        self._lock = threading.Lock()
+        self._applied_cond = threading.Condition(self._lock)
+        self._seq = self._applied = 0
+        # (user, post) -> (liked, seq) of toggles not yet applied
+        self._likes = {}
+        # user -> seq of their last queued intent
+        self._users = {}
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def toggle_like(self, user_id, post_id):
+        """Queue a like or unlike; returns whether the post ends up liked."""
+        key = (user_id, post_id)
+
+        while True:
+            with self._lock:
+                applied = self._applied
+
+            liked = get_db().execute(
+                'SELECT EXISTS (SELECT 1 FROM post_like WHERE post_id = ? AND user_id = ?)', (post_id, user_id)
+            ).fetchone()[0]
+
+            with self._lock:
+                # a batch applied since the read may have committed and
+                # forgotten a pending toggle the read did not see
+                if self._applied != applied:
+                    continue
+
+                liked = self._likes.get(key, (liked,))[0]
+                seq = self._put(user_id, ('like', user_id, post_id, not liked))
+                self._likes[key] = (not liked, seq)
+
+            return not liked
+
+    def add_comment(self, user_id, post_id, body):
+        with self._lock:
+            self._put(user_id, ('comment', user_id, post_id, body))
+
+    def _put(self, user_id, intent):
+        try:
+            self._queue.put_nowait((self._seq + 1, intent))
+        except queue.Full:
+            raise ServiceUnavailable('Too many writes in progress, please retry.', retry_after=1) from None
+
+        self._seq += 1
+        self._users[user_id] = self._seq
+
+        return self._seq
+
+    def wait_for(self, user_id):
+        """Block until every intent queued by ``user_id`` is applied."""
+        with self._lock:
+            target = self._users.get(user_id)
+            if target is not None:
+                self._applied_cond.wait_for(lambda: self._applied >= target, self.wait_timeout)
+
+    def _run(self):
+        stopping = False
+
+        while not stopping:
+            first = self._queue.get()
+            batch = [first]
+            deadline = time.monotonic() + self.interval
+
+            # gather until the window closes or the batch is full
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            stopping = any(item is None for item in batch)
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self._apply(batch)
+
+    def _apply(self, batch):
+        likes, comments, keys = {}, [], {'feed'}
+
+        for seq, (kind, user_id, post_id, value) in batch:
+            if kind == 'like':
+                likes[user_id, post_id] = value
+                keys.add(f'likes:{post_id}')
+            else:
+                comments.append((user_id, post_id, value))
+                keys.add(f'comments:{post_id}')
+
+        pool = get_pool(self.app)
+        events = []
+        try:
+            db = pool.acquire()
+            try:
+                events = self._write(db, likes, comments, keys)
+            finally:
+                pool.release(db)
+            self.batches += 1
+        except Exception:
+            # the intents are dropped; waiting readers are released below
+            self.app.logger.exception('Write-behind batch of %d intents failed', len(batch))
+
+        last = batch[-1][0]
+        with self._lock:
+            self._applied = last
+            for key in likes:
+                if self._likes.get(key, (None, last + 1))[1] <= last:
+                    del self._likes[key]
+            for user_id in [user_id for user_id, seq in self._users.items() if seq <= last]:
+                del self._users[user_id]
+            self._applied_cond.notify_all()
+
+        for post_id, event, data in events:
+            publish_post_event(post_id, event, app=self.app, **data)
+
+    def _write(self, db, likes, comments, keys):
+        # intents for posts deleted since they were queued are skipped, as
+        # the foreign keys would otherwise fail the whole batch
+        db.executemany(
+            'INSERT INTO post_like (user_id, post_id) SELECT ?1, ?2'
+            ' WHERE EXISTS (SELECT 1 FROM post WHERE id = ?2)'
+            ' ON CONFLICT (post_id, user_id) DO NOTHING',
+            [key for key, liked in likes.items() if liked]
+        )
+        db.executemany(
+            'DELETE FROM post_like WHERE user_id = ? AND post_id = ?',
+            [key for key, liked in likes.items() if not liked]
+        )
+        comment_ids = [
+            row[0] for row in (
+                db.execute(
+                    'INSERT INTO post_comment (user_id, post_id, body) SELECT ?1, ?2, ?3'
+                    ' WHERE EXISTS (SELECT 1 FROM post WHERE id = ?2) RETURNING id', comment
+                ).fetchone()
+                for comment in comments
+            ) if row is not None
+        ]
+        bump_versions(db, *sorted(keys))
+        events = self._events(db, {post_id for user_id, post_id in likes}, comment_ids)
+        db.commit()
+
+        return events
+
+    def _events(self, db, liked_posts, comment_ids):
+        """The live events of a batch: the new like count of every post
+        liked or unliked, and each comment with its post's count after the
+        batch."""
+        events = []
+
+        if liked_posts:
+            rows = db.execute(
+                f"SELECT id, like_count FROM post WHERE id IN ({', '.join('?' * len(liked_posts))})",
+                tuple(liked_posts)
+            )
+            events += [(row['id'], 'likes', {'like_count': row['like_count']}) for row in rows]
+
+        if comment_ids:
+            rows = db.execute(
+                'SELECT c.id, c.post_id, c.body, c.created, c.user_id, username, comment_count'
+                ' FROM post_comment c JOIN user u ON c.user_id = u.id JOIN post p ON c.post_id = p.id'
+                f" WHERE c.id IN ({', '.join('?' * len(comment_ids))})"
+                ' ORDER BY c.id',
+                comment_ids
+            )
+            events += [(row['post_id'], 'comment', {'comment': comment_data(row),
+                                                    'comment_count': row['comment_count']}) for row in rows]
+
+        return events
+
+    def close(self):
+        """Apply everything queued and stop the writer thread."""
+        if self._thread.is_alive() and self.pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+
+
+def get_writer():
+    """The process's WriteBehind, or None when WRITE_BEHIND is off."""
+    if not current_app.config['WRITE_BEHIND']:
+        return None
+
+    writer = current_app.extensions.get('write_behind')
+
+    # the writer thread of a parent process does not survive fork()
+    if writer is None or writer.pid != os.getpid():
+        with _writer_lock:
+            writer = current_app.extensions.get('write_behind')
+            if writer is None or writer.pid != os.getpid():
+                writer = current_app.extensions['write_behind'] = WriteBehind(current_app._get_current_object())
+
+    return writer
+
+
+def wait_for_own_writes():
+    writer = current_app.extensions.get('write_behind')
+
+    if (writer is not None and writer.pid == os.getpid() and g.get('user') is not None
+            and request.endpoint not in WRITE_ENDPOINTS):
+        writer.wait_for(g.user['id'])
+
+
+def init_app(app):
+    # after auth has loaded g.user and before ETags are computed from versions
+    app.before_request(wait_for_own_writes)
@@ -0,0 +1,61 @@
+import pytest
+
+from personal import create_app
+from personal.db import get_db, get_pool, init_db
+from personal.hashing import hash_password
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'SECRET_KEY': 'test',
+        'DATABASE': str(tmp_path / 'personal.sqlite'),
+        'CACHE_PATH': str(tmp_path / 'cache.sqlite'),
+        'LIVE_PATH': str(tmp_path / 'live.sqlite'),
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'BACKUP_FOLDER': str(tmp_path / 'backups'),
+        'TEMPLATE_CACHE_DIR': None,
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        'PASSWORD_HASH_WORKERS': 0,
+        'MAINTENANCE_SCHEDULE': {},
+    })
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.executemany(
+            'INSERT INTO user (uuid, username, password) VALUES (?, ?, ?)',
+            [('test.100', 'test', hash_password('test')), ('other.101', 'other', hash_password('other'))]
+        )
+        db.commit()
+
+    yield app
+
+    get_pool(app).close()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def runner(app):
+    return app.test_cli_runner()
+
+
+class AuthActions:
+    def __init__(self, client):
+        self._client = client
+
+    def login(self, username='test', password='test'):
+        return self._client.post('/auth/login', data={'username': username, 'password': password})
+
+    def logout(self):
+        return self._client.get('/auth/logout')
+
+
+@pytest.fixture
+def auth(client):
+    return AuthActions(client)
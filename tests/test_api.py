@@ -0,0 +1,67 @@
+import tracemalloc
+import uuid
+
+from personal.db import get_db, get_pool
+
+
+def add_posts(app, count):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO post (uuid, title, body, author_id, is_public) VALUES (?, ?, ?, 1, 1)',
+            ((str(uuid.uuid4()), f'title {n}', 'word ' * 50) for n in range(count))
+        )
+        db.commit()
+
+
+def export_peak(client):
+    """Bytes streamed from the posts export and the peak memory traced
+    while streaming them."""
+    tracemalloc.start()
+    try:
+        response = client.get('/api/export/posts', buffered=False)
+        received = sum(len(chunk) for chunk in response.response)
+        response.close()
+        return received, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_export_memory_is_flat(app, client, auth):
+    app.config['EXPORT_CHUNK_SIZE'] = 200
+    auth.login()
+    results = []
+
+    for count in (1000, 10000):
+        add_posts(app, count - sum(size for size, _, _ in results))
+        received, peak = export_peak(client)
+        results.append((count, received, peak))
+
+    (_, small_received, small_peak), (_, large_received, large_peak) = results
+    assert large_received > 9 * small_received
+    assert large_peak < 2 * small_peak
+
+
+def test_partial_read_releases_connection(app, client, auth):
+    app.config['EXPORT_CHUNK_SIZE'] = 10
+    auth.login()
+    add_posts(app, 100)
+
+    pool = get_pool(app)
+
+    # past the first chunk, which the view reads before streaming starts
+    response = client.get('/api/export/posts', buffered=False)
+    chunks = iter(response.response)
+    assert [next(chunks) for _ in range(3)]
+    # nothing is held between chunks, and a connection the stream gave
+    # back can go to another request without the stream still using it
+    assert pool._idle.qsize() == pool._opened
+    pool._discard(pool.acquire())
+    assert next(chunks)
+    response.close()
+    assert pool._idle.qsize() == pool._opened
+
+    with app.app_context():
+        # a statement left open would keep the checkpoint from finishing
+        busy, _, _ = get_db().execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    assert busy == 0
@@ -0,0 +1,28 @@
+import personal.auth
+from personal.db import get_pool
+
+
+def test_login(client, auth):
+    response = auth.login()
+    assert response.headers['Location'] == '/'
+
+    with client.session_transaction() as session:
+        assert session['user_id'] == 1
+
+
+def test_passwords_hash_without_a_connection(app, client, auth, monkeypatch):
+    pool = get_pool(app)
+    held = []
+
+    def watched(hashing):
+        def wrapper(*args):
+            held.append(pool._opened - pool._idle.qsize())
+            return hashing(*args)
+        return wrapper
+
+    monkeypatch.setattr(personal.auth, 'verify_password', watched(personal.auth.verify_password))
+    monkeypatch.setattr(personal.auth, 'hash_password', watched(personal.auth.hash_password))
+
+    client.post('/auth/register', data={'username': 'new', 'password': 'new'})
+    auth.login()
+    assert held == [0, 0]
@@ -0,0 +1,77 @@
+import contextlib
+import uuid
+
+import pytest
+from flask import g, request_finished
+
+from personal.db import get_db
+
+
+@contextlib.contextmanager
+def query_counts(app):
+    """Statements run by each request made inside the block."""
+    counts = []
+
+    def record(sender, response, **extra):
+        counts.append(g.db.query_count)
+
+    with request_finished.connected_to(record, app):
+        yield counts
+
+
+def add_activity(db, post_id, likes, comments, images):
+    db.executemany('INSERT INTO post_like (user_id, post_id) VALUES (?, ?)',
+                   [(user_id, post_id) for user_id in (1, 2)[:likes]])
+    db.executemany('INSERT INTO post_comment (user_id, post_id, body) VALUES (2, ?, ?)',
+                   [(post_id, f'comment {c}') for c in range(comments)])
+    for i in range(images):
+        blob_hash = uuid.uuid4().hex
+        db.execute("INSERT INTO upload_blob (hash, size, content_type) VALUES (?, 1, 'image/jpeg')",
+                   (blob_hash,))
+        db.execute('INSERT INTO post_image (post_id, name, blob_hash) VALUES (?, ?, ?)',
+                   (post_id, f'image{i}.jpg', blob_hash))
+
+
+def add_posts(app, count, **activity):
+    with app.app_context():
+        db = get_db()
+        for n in range(count):
+            post_id = db.execute(
+                'INSERT INTO post (uuid, title, body, author_id, is_public) VALUES (?, ?, ?, 1, 1)',
+                (str(uuid.uuid4()), f'title {n}', f'body {n}')
+            ).lastrowid
+            add_activity(db, post_id, **activity)
+        db.commit()
+
+
+def add_to_posts(app, **activity):
+    with app.app_context():
+        db = get_db()
+        for row in db.execute('SELECT id FROM post').fetchall():
+            add_activity(db, row['id'], **activity)
+        db.commit()
+
+
+@pytest.mark.parametrize(('path', 'queries', 'shown'), (
+    ('/blog', 4, b'bi-hand-thumbs-up-fill'),
+    ('/1/details', 5, b'image2.jpg'),
+))
+def test_query_count_is_constant(app, client, auth, path, queries, shown):
+    # every request renders, so the count is that of a full page
+    app.config['CACHE_TYPE'] = 'null'
+    auth.login()
+    add_posts(app, 3, likes=0, comments=0, images=0)
+    # loads the logged-in user into its cache
+    client.get(path)
+
+    with query_counts(app) as counts:
+        client.get(path)
+        # post 1 and the rest of the feed gain likes, comments and images,
+        # and new posts arrive with their own
+        add_to_posts(app, likes=2, comments=10, images=3)
+        add_posts(app, 15, likes=2, comments=10, images=3)
+        response = client.get(path)
+
+    assert response.status_code == 200
+    assert shown in response.data
+    assert counts == [queries, queries]
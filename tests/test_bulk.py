@@ -0,0 +1,40 @@
+import json
+
+from personal.db import get_db
+
+
+def test_import_normalizes_timestamps(app, client, auth, runner, tmp_path):
+    path = tmp_path / 'posts.ndjson'
+    rows = [
+        {'author': 'test.100', 'title': 'iso', 'body': 'iso body', 'is_public': 1, 'created': '2024-01-01T10:00:00Z'},
+        {'author': 'test.100', 'title': 'offset', 'body': 'iso body', 'is_public': 1,
+         'created': '2024-01-01T12:00:00+02:00'},
+        {'author': 'test.100', 'title': 'broken', 'body': 'iso body', 'is_public': 1, 'created': 'yesterday'},
+    ]
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+
+    with app.app_context():
+        result = runner.invoke(args=['import', 'posts', str(path), '--offline'])
+        created = [row[0] for row in get_db().execute('SELECT created FROM post ORDER BY id').fetchall()]
+
+    assert result.exit_code == 1
+    assert "row 3: 'yesterday'" in result.output
+    assert [str(value) for value in created] == ['2024-01-01 10:00:00', '2024-01-01 10:00:00']
+
+    auth.login()
+    for path in ('/blog', '/1/details', '/search?q=iso', '/api/export/posts'):
+        response = client.get(path)
+        assert response.status_code == 200, path
+        response.get_data()
+
+
+def test_import_needs_the_app_stopped(app, runner, tmp_path):
+    path = tmp_path / 'posts.ndjson'
+    path.write_text(json.dumps({'author': 'test.100', 'title': 'title', 'body': 'body', 'is_public': 1}) + '\n')
+
+    with app.app_context():
+        result = runner.invoke(args=['import', 'posts', str(path)], input='n\n')
+        count = get_db().execute('SELECT COUNT(*) FROM post').fetchone()[0]
+
+    assert result.exit_code == 1
+    assert count == 0
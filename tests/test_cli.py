@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+
+def test_bench_is_not_imported_by_create_app(tmp_path):
+    # in a fresh interpreter, as other tests may have imported it
+    script = (
+        'import sys; from personal import create_app;'
+        f" create_app({{'DATABASE': {str(tmp_path / 'personal.sqlite')!r}}});"
+        " print('personal.bench' in sys.modules)"
+    )
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == 'False'
+
+
+def test_bench_commands_load_on_use(runner):
+    result = runner.invoke(args=['bench', '--help'])
+
+    assert result.exit_code == 0
+    assert 'search' in result.output
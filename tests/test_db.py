@@ -0,0 +1,20 @@
+from personal.db import get_db, migrate
+from personal.trending import check_trending
+
+
+def test_trending_migration_replays(app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (uuid, title, body, author_id, is_public) VALUES ('m-post', 't', 'b', 1, 1)")
+        db.execute('INSERT INTO post_like (user_id, post_id) VALUES (2, 1)')
+        db.execute("INSERT INTO post_comment (user_id, post_id, body) VALUES (2, 1, 'c')")
+        db.executescript(
+            'DROP TRIGGER post_like_trending_insert; DROP TRIGGER post_like_trending_delete;'
+            ' DROP TRIGGER post_comment_trending_insert; DROP TRIGGER post_comment_trending_delete;'
+            ' DROP TRIGGER post_trending_visibility; DROP TABLE post_trending; DROP TABLE trending_clock;'
+            ' DELETE FROM schema_migrations WHERE version = 10;'
+        )
+
+        assert migrate() == ['0010_trending.py']
+        assert db.execute('SELECT score FROM post_trending WHERE post_id = 1').fetchone()[0] > 3.9
+        assert check_trending(db, app.config['TRENDING_FLOOR']) == []
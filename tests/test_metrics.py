@@ -0,0 +1,16 @@
+def test_metrics_only_for_loopback_by_default(client):
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 403
+
+
+def test_metrics_token(app, client):
+    app.config['METRICS_TOKEN'] = 'secret'
+    remote = {'REMOTE_ADDR': '203.0.113.7'}
+
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', environ_base=remote,
+                      headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+    response = client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert b'personal_request_duration_seconds' in response.data
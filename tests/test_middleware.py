@@ -0,0 +1,83 @@
+from flask import template_rendered
+
+from personal.db import get_db
+
+
+def add_post(app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO post (uuid, title, body, author_id, is_public) VALUES ('etag-post', 'title', 'body', 1, 1)"
+        )
+        db.commit()
+
+
+def etag(client, path='/1/details'):
+    response = client.get(path)
+    assert response.status_code == 200
+
+    return response.headers['ETag']
+
+
+def test_not_modified_does_not_render(app, client, auth):
+    auth.login()
+    add_post(app)
+    tag = etag(client)
+    rendered = []
+
+    def record(sender, template, context, **extra):
+        rendered.append(template.name)
+
+    with template_rendered.connected_to(record, app):
+        response = client.get('/1/details', headers={'If-None-Match': tag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+    assert rendered == []
+
+
+def test_etag_changes(app, client, auth):
+    auth.login()
+    add_post(app)
+    tags = [etag(client)]
+
+    client.post('/1/post_like')
+    tags.append(etag(client))
+
+    client.post('/1/post_comment', data={'body': 'a comment'})
+    tags.append(etag(client))
+
+    auth.logout()
+    auth.login('other', 'other')
+    tags.append(etag(client))
+
+    assert len(set(tags)) == len(tags)
+
+
+def test_etag_follows_asset_manifest(app, client, auth):
+    auth.login()
+    add_post(app)
+    app.extensions['asset_manifest'] = {'base.css': 'dist/base.1111.css'}
+    before = etag(client)
+    app.extensions['asset_manifest'] = {'base.css': 'dist/base.2222.css'}
+
+    assert client.get('/1/details', headers={'If-None-Match': before}).status_code == 200
+
+
+def test_vary_on_every_compressible_response(app, client, auth):
+    app.config['GZIP_MIN_SIZE'] = 1024 * 1024
+    auth.login()
+    add_post(app)
+
+    small = client.get('/1/details')
+    assert 'Content-Encoding' not in small.headers
+    assert 'Accept-Encoding' in small.vary
+
+    not_modified = client.get('/1/details', headers={'If-None-Match': small.headers['ETag']})
+    assert not_modified.status_code == 304
+    assert 'Accept-Encoding' in not_modified.vary
+
+    app.config['GZIP_MIN_SIZE'] = 0
+    gzipped = client.get('/1/details', headers={'Accept-Encoding': 'gzip'})
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in gzipped.vary
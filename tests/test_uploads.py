@@ -0,0 +1,44 @@
+import io
+
+import pytest
+
+from personal.db import get_db
+
+HTML = b'<html><script>alert(document.cookie)</script></html>'
+
+
+@pytest.mark.parametrize('accel', (None, '/_uploads'))
+def test_upload_type_comes_from_extension(app, client, auth, accel):
+    app.config['UPLOAD_ACCEL_REDIRECT'] = accel
+    auth.login()
+    client.post('/blog/create', data={
+        'title': 'image', 'body': 'body', 'file': (io.BytesIO(HTML), 'x.png', 'text/html'),
+    }, content_type='multipart/form-data')
+
+    with app.app_context():
+        blob_hash, content_type = get_db().execute(
+            'SELECT hash, content_type FROM upload_blob'
+        ).fetchone()
+
+    assert content_type == 'image/png'
+
+    response = client.get(f'/uploads/{blob_hash}')
+    assert response.status_code == 200
+    assert response.mimetype.startswith('image/')
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+
+
+def test_stored_unsafe_type_is_served_as_download(app, client, auth):
+    auth.login()
+    client.post('/blog/create', data={
+        'title': 'image', 'body': 'body', 'file': (io.BytesIO(HTML), 'x.png', 'text/html'),
+    }, content_type='multipart/form-data')
+
+    with app.app_context():
+        db = get_db()
+        # as written by versions that trusted the client's type
+        db.execute("UPDATE upload_blob SET content_type = 'text/html'")
+        db.commit()
+        blob_hash = db.execute('SELECT hash FROM upload_blob').fetchone()[0]
+
+    assert client.get(f'/uploads/{blob_hash}').mimetype == 'application/octet-stream'
@@ -0,0 +1,21 @@
+from personal.db import get_db
+from personal.warmup import warm_pages
+
+
+def test_warm_pages_reads_the_feed(app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (uuid, title, body, author_id, is_public) VALUES ('warm', 'title', 'body', 1, 1)")
+        db.commit()
+        statements = []
+        db.set_trace_callback(statements.append)
+        try:
+            warm_pages()
+        finally:
+            db.set_trace_callback(None)
+
+        plans = [' '.join(row['detail'] for row in db.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall())
+                 for sql in statements if sql.lstrip().upper().startswith('SELECT') and '?' not in sql]
+
+    assert any('FROM post p JOIN user u' in sql and 'is_public = 1' in sql for sql in statements)
+    assert any('post_public_created_idx' in plan for plan in plans)
@@ -0,0 +1,40 @@
+from personal import writebehind
+from personal.db import get_db
+from personal.writebehind import get_writer
+
+
+class FlushAfterRead:
+    """A connection whose reads return only once the writer has applied
+    everything queued so far, as if the batch landed between the read and
+    the use of its result."""
+
+    def __init__(self, db, writer, target):
+        self.db = db
+        self.writer = writer
+        self.target = target
+
+    def execute(self, *args):
+        cursor = self.db.execute(*args)
+        with self.writer._lock:
+            assert self.writer._applied_cond.wait_for(lambda: self.writer._applied >= self.target, 5)
+
+        return cursor
+
+
+def test_toggle_like_survives_flush_between_read_and_lock(app, monkeypatch):
+    app.config['WRITE_BEHIND'] = True
+
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (uuid, title, body, author_id) VALUES ('wb-post', 'title', 'body', 1)")
+        db.commit()
+
+        writer = get_writer()
+        assert writer.toggle_like(1, 1) is True
+
+        monkeypatch.setattr(writebehind, 'get_db', lambda: FlushAfterRead(db, writer, 1))
+        assert writer.toggle_like(1, 1) is False
+        monkeypatch.undo()
+
+        writer.close()
+        assert db.execute('SELECT COUNT(*) FROM post_like').fetchone()[0] == 0